@@ -1,29 +1,211 @@
 
-from flask import Flask, request, jsonify, Response
-from flask_cors import CORS
+from quart import Quart, request, jsonify, Response
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers.response import DataBody
+from quart_cors import cors
 import os
-import json
+import io
+import re
+import gzip
+import struct
+import asyncio
+import atexit
+import functools
+import threading
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import orjson
+import httpx
 import openai
+import tiktoken
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+import numpy as np
 import psycopg2
-from psycopg2.extras import Json, DictCursor
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
+import click
+from contextlib import contextmanager
 from datetime import datetime
-import difflib
+import hashlib
+from rapidfuzz import fuzz, process
+import sqlglot
+from sqlglot import exp
+from cachetools import LRUCache
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from pydantic import ValidationError
+
+from batch import submit_batch, retrieve_batch, parse_batch_line
+from cache import ResultCache
+from group_commit import GroupCommitter
+from minhash import lsh_bands
+from schemas import OptimizeRequest, RequestValidationError, context_size
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+# Hand log records to a background thread so a slow stderr sink never blocks a request
+log_queue = SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[QueueHandler(log_queue)]
+)
+logger = logging.getLogger(__name__)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that parses requests and serializes responses with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Write the encoded bytes straight into the response, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+# Initialize Quart app (async Flask-compatible API served over ASGI)
+app = Quart(__name__)
+app.json = OrjsonProvider(app)  # Route request.get_json() and jsonify() through orjson
+app = cors(app, allow_origin="*")  # Enable CORS for all routes
+
+# Gzip JSON responses of at least COMPRESS_MIN_SIZE bytes; analyses and rewritten queries
+# are verbose text that shrinks several times. Level 4 gets close to the best ratio on
+# JSON at a fraction of the CPU time of level 9.
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+COMPRESS_LEVEL = 4
+COMPRESS_MIMETYPES = {"application/json"}
+
+@app.after_request
+async def compress_response(response):
+    """Gzip a JSON response body for clients that accept it."""
+    # Streamed bodies (server-sent events, batch results) are sent as they are produced
+    if (
+        response.mimetype not in COMPRESS_MIMETYPES
+        or not isinstance(response.response, DataBody)
+        or "Content-Encoding" in response.headers
+        or "gzip" not in request.accept_encodings
+    ):
+        return response
+    
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
 
 # Get OpenAI API key from environment variables
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
-    print("Warning: OPENAI_API_KEY not found in environment variables.")
+    logger.warning("OPENAI_API_KEY not found in environment variables.")
+
+# Shared HTTP/2 connection pool so concurrent OpenAI calls reuse TLS sessions
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+
+# Configure OpenAI API (async client so network waits don't block the event loop)
+client = openai.AsyncOpenAI(api_key=openai_api_key, http_client=http_client)
+
+# Limit concurrent in-flight chat completions per worker
+OPENAI_MAX_INFLIGHT = int(os.getenv("OPENAI_MAX_INFLIGHT", "8"))
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_INFLIGHT)
+
+# Optional per-worker request and token rates for chat completions, matching the account's
+# RPM/TPM limits, so bursts wait here instead of coming back as 429s. Unset means unlimited.
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))
+openai_request_limiter = AsyncLimiter(OPENAI_RPM_LIMIT, 60) if OPENAI_RPM_LIMIT else None
+openai_token_limiter = AsyncLimiter(OPENAI_TPM_LIMIT, 60) if OPENAI_TPM_LIMIT else None
+
+# Transient OpenAI errors that are worth retrying
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)
+
+# Cache of optimization responses keyed by the normalized request, so resubmitting the
+# same SQL and context skips OpenAI and the database. Set REDIS_URL to share it between workers.
+OPTIMIZATION_CACHE_SIZE = int(os.getenv("OPTIMIZATION_CACHE_SIZE", "512"))
+OPTIMIZATION_CACHE_TTL = int(os.getenv("OPTIMIZATION_CACHE_TTL", "3600"))
+result_cache = ResultCache(
+    OPTIMIZATION_CACHE_SIZE,
+    OPTIMIZATION_CACHE_TTL,
+    redis_url=os.getenv("REDIS_URL"),
+    namespace="optimization"
+)
+
+# Query embeddings come from OpenAI by default. Set EMBEDDING_BACKEND=fastembed to compute
+# them on the local CPU with a quantized ONNX model instead (pip install fastembed), which
+# takes the embeddings round-trip off every request. The two models' embeddings can't be
+# compared, so switching discards the stored ones.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+if EMBEDDING_BACKEND == "fastembed":
+    from fastembed import TextEmbedding
+    
+    EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+    EMBEDDING_DIMENSIONS = 384
+else:
+    # Shortened to this many dimensions by the API and stored in half precision, so each
+    # takes 1 KB in QueryVectors and its HNSW index
+    EMBEDDING_MODEL = "text-embedding-3-small"
+    EMBEDDING_DIMENSIONS = 512
+
+# In-process cache of query embeddings keyed by normalized SQL. Embeddings are stored as
+# float32 arrays (2 KB each) and only touched from the event loop thread.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+embedding_cache = LRUCache(maxsize=EMBEDDING_CACHE_SIZE)
+
+# Most positively rated queries sharing an LSH band that are compared against a query
+# when pg_trgm is unavailable
+LSH_CANDIDATES = 500
+
+# Seconds between checks of submitted Batch API jobs
+BATCH_POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "60"))
+
+# Batch API statuses after which a batch never changes again
+FINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Number of stored queries embedded per request and written per COPY by backfill-embeddings
+EMBEDDING_BACKFILL_BATCH_SIZE = 256
+
+# Upper bound on the combined size of everything copied from a request into the prompt
+MAX_PROMPT_BYTES = int(os.getenv("MAX_PROMPT_BYTES", "300000"))
+
+# Token limits for the prompt sent to the model and for its answer
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "100000"))
+COMPLETION_MAX_TOKENS = int(os.getenv("COMPLETION_MAX_TOKENS", "2000"))
+
+# Requests answered together by /api/optimize/multi: prompt tokens and number of
+# requests packed into one chat completion, and the most requests accepted at once
+MULTI_PROMPT_TOKEN_BUDGET = int(os.getenv("MULTI_PROMPT_TOKEN_BUDGET", "8000"))
+MULTI_MAX_QUERIES_PER_CALL = 8
+MULTI_MAX_QUERIES = 50
 
-# Configure OpenAI API
-client = openai.OpenAI(api_key=openai_api_key)
+# Most tokens gpt-4o can generate in one completion
+MODEL_MAX_COMPLETION_TOKENS = 16384
+
+# The estimated improvement: the number before a percent sign, as in "Up to 75% faster",
+# or a bare number such as "75"
+IMPROVEMENT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(?:%|$)")
+
+# Tokenizer matching the chat model, used to measure prompts before sending them
+token_encoding = tiktoken.encoding_for_model("gpt-4o")
+
+# Context fields that may be clipped when a prompt is over the token budget
+TRUNCATABLE_FIELDS = ("tableStructure", "existingIndexes", "performanceIssue", "explainResults", "serverInfo")
 
 # Database connection parameters
 DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -32,206 +214,652 @@ DB_NAME = os.getenv('DB_NAME', 'sql_optimizer')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 
-def get_db_connection():
-    """Create and return a PostgreSQL database connection"""
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    return conn
+# Connection pool bounds per worker process
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
 
-def init_db():
-    """Initialize PostgreSQL database with tables from UML schema"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Optional synchronous_commit for the app's sessions. With "off" a commit returns before
+# its WAL record is flushed to disk, so writes don't wait on fsync; a database crash can
+# lose the last moments of saved requests (their queries are just sent to OpenAI again)
+# but never corrupts data.
+DB_SYNCHRONOUS_COMMIT = os.getenv('DB_SYNCHRONOUS_COMMIT')
+
+# Write statements issued on every request, prepared once per pooled connection so
+# the server skips parsing and planning them again
+PREPARED_STATEMENTS = {
+    "insert_feedback": """
+        INSERT INTO Feedbacks (result_id, is_useful) VALUES ($1, $2) RETURNING feedback_id
+    """,
+    "insert_query_request": """
+        INSERT INTO QueryRequests
+        (original_query, table_structures, existing_indexes, performance_issues,
+         explain_results, server_info, database_engine, database_version, database_size,
+         canonical_query, canonical_hash, lsh_bands)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+        RETURNING request_id
+    """,
+    "insert_optimization_result": """
+        INSERT INTO OptimizationResults
+        (request_id, optimized_query, optimization_explanation, suggested_indexes,
+         suggested_schema_changes, suggested_server_configs, estimated_improvement,
+         tokens_used, model_used)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        RETURNING result_id
+    """,
+    "insert_query_vector": """
+        INSERT INTO QueryVectors (request_id, embedding) VALUES ($1, $2) RETURNING vector_id
+    """,
+    "insert_similar_query": """
+        INSERT INTO SimilarQueries
+        (request_id, similar_request_id, similarity_score, similarity_type)
+        VALUES ($1, $2, $3, $4)
+        RETURNING id
+    """
+}
+
+class Json(psycopg2.extras.Json):
+    """psycopg2 JSON parameter adapter that encodes with orjson instead of the json module."""
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements have been prepared on its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+class ConnectionPool(ThreadedConnectionPool):
+    """Pool that opens minconn connections up front but keeps up to maxconn open for reuse."""
+
+    def _putconn(self, conn, key=None, close=False):
+        # psycopg2 (2.9) keeps a returned connection only while fewer than minconn are idle
+        # and closes it otherwise, so every checkout beyond DB_POOL_MIN concurrent ones would
+        # reconnect and prepare its statements again. Its _putconn reads minconn for nothing
+        # else and runs under the pool lock, so raise the limit to maxconn just for the call.
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+# ThreadedConnectionPool raises instead of waiting when every connection is checked
+# out, so callers queue on this semaphore first
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# psycopg2 type adapters are process-wide, so pgvector only has to be registered once
+pgvector_registered = False
+
+def reset_after_fork():
+    """Give a forked worker its own database pool, writer and log listener thread."""
+    global db_pool, db_pool_lock, db_pool_slots, group_committer
+    # Connections opened before the fork belong to the parent; keep them referenced so
+    # the child never closes (and so terminates) the parent's sessions
+    if db_pool is not None:
+        inherited_db_pools.append(db_pool)
+    db_pool = None
+    db_pool_lock = threading.Lock()
+    db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+    group_committer = GroupCommitter(db_conn, DB_WRITE_GROUP_SIZE)
     
-    # Create tables based on UML schema
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS QueryRequests (
-        request_id SERIAL PRIMARY KEY,
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        original_query TEXT NOT NULL,
-        table_structures JSONB,
-        existing_indexes JSONB,
-        explain_results JSONB,
-        performance_issues TEXT,
-        database_size INTEGER,
-        database_engine VARCHAR(50),
-        database_version VARCHAR(50),
-        server_info JSONB
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS OptimizationResults (
-        result_id SERIAL PRIMARY KEY,
-        request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        optimized_query TEXT NOT NULL,
-        optimization_explanation TEXT NOT NULL,
-        suggested_indexes JSONB,
-        suggested_schema_changes JSONB,
-        suggested_server_configs JSONB,
-        estimated_improvement FLOAT,
-        tokens_used INTEGER,
-        model_used VARCHAR(50)
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Feedbacks (
-        feedback_id SERIAL PRIMARY KEY,
-        result_id INTEGER NOT NULL REFERENCES OptimizationResults(result_id),
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        is_useful BOOLEAN NOT NULL
-    )
-    ''')
+    # Threads don't survive a fork, so restart the one emitting queued log records
+    log_listener.start()
+
+inherited_db_pools = []
+
+# Gunicorn's preload_app imports this module once in the master and forks the workers
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def get_db_pool():
+    """Return the PostgreSQL connection pool, creating it on first use."""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    options=f"-c synchronous_commit={DB_SYNCHRONOUS_COMMIT}" if DB_SYNCHRONOUS_COMMIT else None,
+                    connection_factory=PooledConnection
+                )
+    return db_pool
+
+def register_pgvector(conn):
+    """Register the pgvector adapters the first time a connection is checked out."""
+    global pgvector_registered
+    if pgvector_registered:
+        return
+    try:
+        register_vector(conn)
+        pgvector_registered = True
+    except psycopg2.ProgrammingError:
+        # The vector extension does not exist until init_db creates it
+        pass
+
+@contextmanager
+def db_conn():
+    """Check a connection out of the pool and return it when the block exits."""
+    with db_pool_slots:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        try:
+            register_pgvector(conn)
+            yield conn
+        finally:
+            # putconn rolls back anything left uncommitted and discards closed connections
+            pool.putconn(conn)
+
+# Request writes go through one writer thread that commits whatever has queued up
+# together, so concurrent requests share a commit instead of each paying for one
+DB_WRITE_GROUP_SIZE = int(os.getenv('DB_WRITE_GROUP_SIZE', '64'))
+group_committer = GroupCommitter(db_conn, DB_WRITE_GROUP_SIZE)
+
+def execute_prepared(cursor, name, params):
+    """Execute one of PREPARED_STATEMENTS, preparing it first if this connection hasn't yet."""
+    conn = cursor.connection
+    if name not in conn.prepared_statements:
+        # Prepared statements belong to the session and survive rollbacks
+        cursor.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        conn.prepared_statements.add(name)
     
-    cursor.execute('''
-    CREATE EXTENSION IF NOT EXISTS vector;
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+def init_db():
+    """Initialize PostgreSQL database with tables from UML schema"""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        
+        # Create tables based on UML schema
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS QueryRequests (
+            request_id SERIAL PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            original_query TEXT NOT NULL,
+            table_structures JSONB,
+            existing_indexes JSONB,
+            explain_results JSONB,
+            performance_issues TEXT,
+            database_size INTEGER,
+            database_engine VARCHAR(50),
+            database_version VARCHAR(50),
+            server_info JSONB,
+            canonical_query TEXT,
+            canonical_hash BYTEA,
+            lsh_bands BIGINT[]
+        )
+        ''')
+        
+        # Canonical form of each query used for similarity search, filled in for rows
+        # saved before it existed
+        cursor.execute("ALTER TABLE QueryRequests ADD COLUMN IF NOT EXISTS canonical_query TEXT")
+        cursor.execute("SELECT request_id, original_query, database_engine FROM QueryRequests WHERE canonical_query IS NULL")
+        missing = [
+            (request_id, canonicalize_query(original_query, database_engine))
+            for request_id, original_query, database_engine in cursor.fetchall()
+        ]
+        execute_values(cursor, """
+            UPDATE QueryRequests qr SET canonical_query = v.canonical_query
+            FROM (VALUES %s) AS v (request_id, canonical_query)
+            WHERE qr.request_id = v.request_id
+        """, missing)
+        
+        # Hash of the canonical query, so repeats of a query are found with one index probe
+        cursor.execute("ALTER TABLE QueryRequests ADD COLUMN IF NOT EXISTS canonical_hash BYTEA")
+        cursor.execute("SELECT request_id, canonical_query FROM QueryRequests WHERE canonical_hash IS NULL")
+        missing = [(request_id, canonical_hash(canonical_query)) for request_id, canonical_query in cursor.fetchall()]
+        execute_values(cursor, """
+            UPDATE QueryRequests qr SET canonical_hash = v.canonical_hash
+            FROM (VALUES %s) AS v (request_id, canonical_hash)
+            WHERE qr.request_id = v.request_id
+        """, missing)
+        cursor.execute("CREATE INDEX IF NOT EXISTS queryrequests_canonical_hash_idx ON QueryRequests (canonical_hash)")
+        
+        # MinHash band hashes of the canonical query, used to find string similarity
+        # candidates when pg_trgm is unavailable
+        cursor.execute("ALTER TABLE QueryRequests ADD COLUMN IF NOT EXISTS lsh_bands BIGINT[]")
+        cursor.execute("SELECT request_id, canonical_query FROM QueryRequests WHERE lsh_bands IS NULL")
+        missing = [(request_id, lsh_bands(canonical_query)) for request_id, canonical_query in cursor.fetchall()]
+        execute_values(cursor, """
+            UPDATE QueryRequests qr SET lsh_bands = v.lsh_bands
+            FROM (VALUES %s) AS v (request_id, lsh_bands)
+            WHERE qr.request_id = v.request_id
+        """, missing, template="(%s, %s::BIGINT[])")
+        cursor.execute("CREATE INDEX IF NOT EXISTS queryrequests_lsh_bands_idx ON QueryRequests USING gin (lsh_bands)")
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS OptimizationResults (
+            result_id SERIAL PRIMARY KEY,
+            request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            optimized_query TEXT NOT NULL,
+            optimization_explanation TEXT NOT NULL,
+            suggested_indexes JSONB,
+            suggested_schema_changes JSONB,
+            suggested_server_configs JSONB,
+            estimated_improvement FLOAT,
+            tokens_used INTEGER,
+            model_used VARCHAR(50)
+        )
+        ''')
+        
+        # Results are always looked up by request, newest first
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS optimizationresults_request_idx
+        ON OptimizationResults (request_id, created_at DESC)
+        ''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Feedbacks (
+            feedback_id SERIAL PRIMARY KEY,
+            result_id INTEGER NOT NULL REFERENCES OptimizationResults(result_id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            is_useful BOOLEAN NOT NULL
+        )
+        ''')
+        
+        # History lookups only ever ask whether a result has positive feedback
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS feedbacks_result_useful_idx ON Feedbacks (result_id) WHERE is_useful
+        ''')
+        
+        cursor.execute(f'''
+        CREATE EXTENSION IF NOT EXISTS vector;
+        
+        CREATE TABLE IF NOT EXISTS QueryVectors (
+            vector_id SERIAL PRIMARY KEY,
+            request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
+            embedding halfvec({EMBEDDING_DIMENSIONS}),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Bring embeddings stored by older versions or another backend to the current type
+        cursor.execute("""
+            SELECT t.typname, a.atttypmod
+            FROM pg_attribute a
+            JOIN pg_type t ON t.oid = a.atttypid
+            WHERE a.attrelid = 'queryvectors'::regclass AND a.attname = 'embedding'
+        """)
+        column_type, dimensions = cursor.fetchone()
+        if (column_type, dimensions) != ('halfvec', EMBEDDING_DIMENSIONS):
+            migrate_query_vectors(cursor, column_type)
+        
+        # Approximate nearest neighbour index for cosine distance (<=>) searches
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS queryvectors_hnsw_idx
+        ON QueryVectors USING hnsw (embedding halfvec_cosine_ops) WITH (m = 16, ef_construction = 64)
+        ''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SimilarQueries (
+            id SERIAL PRIMARY KEY,
+            request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
+            similar_request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
+            similarity_score FLOAT NOT NULL,
+            similarity_type VARCHAR(50) NOT NULL
+        )
+        ''')
+        
+        # Batch API jobs and the requests they answer, listed in the order submitted
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BatchJobs (
+            batch_id VARCHAR(100) PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            status VARCHAR(20) NOT NULL,
+            request_ids INTEGER[] NOT NULL,
+            errors JSONB
+        )
+        ''')
+        
+        # Why requests of a completed batch got no result, keyed by request_id
+        cursor.execute("ALTER TABLE BatchJobs ADD COLUMN IF NOT EXISTS errors JSONB")
+        
+        conn.commit()
+        
+        # Trigram index for string similarity search. pg_trgm is optional: without it
+        # similarity is computed in Python instead.
+        try:
+            cursor.execute('''
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            
+            DROP INDEX IF EXISTS queryrequests_query_trgm_idx;
+            
+            CREATE INDEX IF NOT EXISTS queryrequests_canonical_trgm_idx
+            ON QueryRequests USING gin (canonical_query gin_trgm_ops)
+            ''')
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.warning("pg_trgm is not available, string similarity will be computed in Python: %s", e)
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the database tables and indexes."""
+    init_db()
+    logger.info("Database initialized successfully")
+
+def migrate_query_vectors(cursor, column_type):
+    """Convert QueryVectors.embedding to halfvec(EMBEDDING_DIMENSIONS)."""
+    # The HNSW index is tied to the old type's operator class; init_db rebuilds it
+    cursor.execute("DROP INDEX IF EXISTS queryvectors_hnsw_idx")
     
-    CREATE TABLE IF NOT EXISTS QueryVectors (
-        vector_id SERIAL PRIMARY KEY,
-        request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
-        embedding FLOAT[],
-        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS SimilarQueries (
-        id SERIAL PRIMARY KEY,
-        request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
-        similar_request_id INTEGER NOT NULL REFERENCES QueryRequests(request_id),
-        similarity_score FLOAT NOT NULL,
-        similarity_type VARCHAR(50) NOT NULL
-    )
-    ''')
+    # Older versions stored full 1536-dimension OpenAI embeddings as FLOAT[] or vector.
+    # Shortened text-embedding-3 embeddings are the leading dimensions rescaled, and cosine
+    # distance ignores the scale, so keeping the first dimensions gives the same vectors.
+    if EMBEDDING_BACKEND == "openai" and column_type in ('_float4', '_float8'):
+        using = f"(embedding[1:{EMBEDDING_DIMENSIONS}])::halfvec({EMBEDDING_DIMENSIONS})"
+    elif EMBEDDING_BACKEND == "openai" and column_type == 'vector':
+        using = f"subvector(embedding, 1, {EMBEDDING_DIMENSIONS})::halfvec({EMBEDDING_DIMENSIONS})"
+    else:
+        logger.warning("Discarding stored query embeddings that were not made by %s", EMBEDDING_MODEL)
+        cursor.execute("DELETE FROM QueryVectors")
+        using = "NULL"
     
-    conn.commit()
-    conn.close()
+    cursor.execute(f"ALTER TABLE QueryVectors ALTER COLUMN embedding TYPE halfvec({EMBEDDING_DIMENSIONS}) USING {using}")
 
-# Initialize database on startup
-try:
-    init_db()
-    print("Database initialized successfully")
-except Exception as e:
-    print(f"Error initializing database: {str(e)}")
+@app.cli.command("backfill-embeddings")
+@click.option("--batch-size", default=EMBEDDING_BACKFILL_BATCH_SIZE, show_default=True,
+              help="Queries embedded and written per batch.")
+def backfill_embeddings_command(batch_size):
+    """Embed stored queries that have no embedding, e.g. after switching EMBEDDING_BACKEND."""
+    count = asyncio.run(backfill_query_embeddings(batch_size))
+    logger.info("Backfilled %d query embeddings", count)
+
+def init_db_on_startup():
+    """Initialize the database at startup, logging instead of raising on failure."""
+    try:
+        init_db()
+        logger.info("Database initialized successfully")
+    except Exception as e:
+        logger.error("Error initializing database: %s", e)
+
+# Schema creation is a deploy step (`quart --app app init-db`), so workers don't repeat
+# it on every boot. Set RUN_DB_INIT=1 to run it on import instead.
+if os.getenv("RUN_DB_INIT") == "1":
+    init_db_on_startup()
 
 @app.route('/api/optimize', methods=['POST'])
-def optimize_query():
+async def optimize_query():
     """Endpoint to optimize MySQL queries using OpenAI or retrieval from history."""
     try:
-        # Get request data
-        data = request.json
-        
-        if not data or 'sqlQuery' not in data:
-            return jsonify({"error": "Missing required field: sqlQuery"}), 400
-        
-        # Extract data fields
-        sql_query = data.get('sqlQuery', '')
-        table_structure = data.get('tableStructure', {})
-        existing_indexes = data.get('existingIndexes', {})
-        performance_issue = data.get('performanceIssue', '')
-        explain_results = data.get('explainResults', {})
-        server_info = data.get('serverInfo', {})
-        database_engine = data.get('databaseEngine', 'MySQL')
-        database_version = data.get('databaseVersion', '')
-        database_size = data.get('databaseSize', 0)
-        
-        # Store the query request
-        request_id = save_query_request(
-            sql_query,
-            table_structure,
-            existing_indexes,
-            performance_issue,
-            explain_results,
-            server_info,
-            database_engine,
-            database_version,
-            database_size
-        )
+        # Get and validate request data
+        payload = validate_optimize_request(await request.get_json())
+        
+        # The history lookup needs the canonical form of the query and its embedding;
+        # prepare them while the result cache is checked, which may wait on Redis
+        prepare_task = asyncio.create_task(prepare_query(payload))
+        
+        # Return the earlier response for a repeated request, unless ?cache=false
+        use_cache = request.args.get('cache', 'true').lower() != 'false'
+        cache_key = request_cache_key(payload)
+        if use_cache:
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                # Nothing was spent on this request
+                prepare_task.cancel()
+                return jsonify({**cached, "tokensUsed": 0})
+        
+        sql_query = payload.sqlQuery
+        canonical_query, query_embedding = await prepare_task
         
         # Check if we have a similar query in history with positive feedback
-        similar_optimization = find_similar_optimization(sql_query, request_id)
+        similar_optimization = await find_similar_optimization(payload, canonical_query, query_embedding)
         
         if similar_optimization:
             # Return the similar optimization from history
-            print(f"Found similar optimization in history: Request ID {similar_optimization['request_id']}")
+            logger.info("Found similar optimization in history: Request ID %s", similar_optimization['request_id'])
             
             # Create the response from the similar optimization
-            response = {
-                "originalQuery": sql_query,
-                "optimizedQuery": similar_optimization['optimized_query'],
-                "analysis": similar_optimization['optimization_explanation'],
-                "performanceImprovement": f"{similar_optimization['estimated_improvement']}%",
-                "indexSuggestions": similar_optimization['suggested_indexes'],
-                "structureSuggestions": similar_optimization['suggested_schema_changes'],
-                "serverSuggestions": similar_optimization['suggested_server_configs'],
-                "id": similar_optimization['result_id'],
-                "source": "history"
-            }
+            response = history_response(sql_query, similar_optimization)
             
-            # Save the similarity relationship
-            save_similarity_relationship(
-                request_id, 
-                similar_optimization['request_id'], 
-                similar_optimization['similarity_score'], 
-                "vector_similarity"
-            )
+            # Save the request together with its similarity relationship
+            await run_write(save_history_match, payload, canonical_query, similar_optimization)
+            
+            # A retry of the same request skips the history lookup as well
+            await result_cache.set(cache_key, response)
             
             return jsonify(response)
         
         # Create prompt for OpenAI
-        prompt = create_optimization_prompt(
-            sql_query, 
-            table_structure, 
-            existing_indexes, 
-            performance_issue, 
-            explain_results, 
-            server_info,
-            database_engine,
-            database_version
-        )
+        prompt = create_request_prompt(payload)
         
         # Call OpenAI API for optimization
-        optimization_result = get_optimization_from_openai(prompt)
-        
-        # Save optimization to database
-        result_id = save_optimization_result(
-            request_id,
-            optimization_result.get('optimizedQuery', ''),
-            optimization_result.get('analysis', ''),
-            optimization_result.get('indexSuggestions', []),
-            optimization_result.get('structureSuggestions', []),
-            optimization_result.get('serverSuggestions', []),
-            optimization_result.get('performanceImprovement', ''),
-            optimization_result.get('tokensUsed', 0),
-            'gpt-4o'  # Model used
-        )
+        optimization_result = await get_optimization_from_openai(prompt, sql_query)
+        
+        # Save the request and its optimization, reusing the embedding from the history lookup
+        _, result_id = await save_optimization(payload, canonical_query, optimization_result, query_embedding)
         
         # Add the ID to the response
         optimization_result['id'] = result_id
         optimization_result['source'] = "openai"
         
-        # Generate embedding for the query and save it
-        save_query_embedding(request_id, sql_query)
+        # Only cache successfully parsed optimizations
+        if "error" not in optimization_result:
+            await result_cache.set(cache_key, optimization_result)
         
         # Return the optimized query and analysis
         return jsonify(optimization_result)
         
+    except RequestValidationError as e:
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        logger.exception("Error optimizing query")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/optimize/stream', methods=['POST'])
+async def optimize_query_stream():
+    """Endpoint to optimize a query and stream the model output as server-sent events."""
+    try:
+        payload = validate_optimize_request(await request.get_json())
+        
+        # A repeated request is answered at once with a single result event, unless ?cache=false
+        use_cache = request.args.get('cache', 'true').lower() != 'false'
+        cache_key = request_cache_key(payload)
+        if use_cache:
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                return event_stream_response([
+                    f"event: result\ndata: {orjson.dumps({**cached, 'tokensUsed': 0}).decode('utf-8')}\n\n",
+                    "data: [DONE]\n\n"
+                ])
+        
+        # Answer from a similar, positively rated optimization in history like /api/optimize,
+        # with a single result event
+        canonical_query, query_embedding = await prepare_query(payload)
+        similar_optimization = await find_similar_optimization(payload, canonical_query, query_embedding)
+        if similar_optimization:
+            logger.info("Found similar optimization in history: Request ID %s", similar_optimization['request_id'])
+            response = history_response(payload.sqlQuery, similar_optimization)
+            await run_write(save_history_match, payload, canonical_query, similar_optimization)
+            await result_cache.set(cache_key, response)
+            return event_stream_response([
+                f"event: result\ndata: {orjson.dumps(response).decode('utf-8')}\n\n",
+                "data: [DONE]\n\n"
+            ])
+        
+        # Create prompt for OpenAI
+        prompt = create_request_prompt(payload)
+        
+        async def generate():
+            # The model output is read into a queue by its own task, so a slow client
+            # doesn't hold an OpenAI concurrency slot while it catches up
+            deltas = asyncio.Queue()
+            upstream = asyncio.create_task(stream_chat_completion(build_chat_request(prompt), deltas))
+            try:
+                while (delta := await deltas.get()) is not None:
+                    # JSON-encode each delta so newlines can't break SSE framing
+                    yield f"data: {orjson.dumps(delta).decode('utf-8')}\n\n"
+                content, tokens_used, finish_reason = await upstream
+                
+                # Persist the finished answer like /api/optimize does and tell the
+                # client its id, so feedback can be submitted for it
+                optimization_result = parse_optimization_response(content, tokens_used, finish_reason)
+                if "error" not in optimization_result:
+                    _, result_id = await save_optimization(payload, canonical_query, optimization_result, query_embedding)
+                    saved = {"originalQuery": payload.sqlQuery, "id": result_id, "source": "openai"}
+                    yield f"event: result\ndata: {orjson.dumps(saved).decode('utf-8')}\n\n"
+                    await result_cache.set(cache_key, {**optimization_result, **saved})
+                else:
+                    # The streamed text isn't a usable answer
+                    yield f"event: error\ndata: {orjson.dumps(optimization_result['error']).decode('utf-8')}\n\n"
+            except Exception as e:
+                logger.exception("OpenAI streaming error")
+                yield f"event: error\ndata: {orjson.dumps(str(e)).decode('utf-8')}\n\n"
+            finally:
+                # Stop reading the model output if the client went away
+                upstream.cancel()
+            yield "data: [DONE]\n\n"
+        
+        return event_stream_response(generate())
+        
+    except RequestValidationError as e:
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        logger.exception("Error streaming query optimization")
+        return jsonify({"error": str(e)}), 500
+
+def event_stream_response(events):
+    """Build a server-sent events response that is passed on as soon as each event is written."""
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    response.timeout = None  # Generation can outlast Quart's default response timeout
+    return response
+
+async def stream_chat_completion(chat_request, deltas):
+    """Stream a chat completion, putting each content delta on the deltas queue and None after the last.
+    
+    Returns (content, tokens_used, finish_reason).
+    """
+    parts = []
+    tokens_used = 0
+    finish_reason = None
+    try:
+        await throttle_openai(chat_request)
+        async with openai_semaphore:
+            stream = await client.chat.completions.create(
+                **chat_request,
+                stream=True,
+                stream_options={"include_usage": True}  # Report usage in the last chunk
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    deltas.put_nowait(chunk.choices[0].delta.content)
+    finally:
+        deltas.put_nowait(None)
+    return "".join(parts), tokens_used, finish_reason
+
+@app.route('/api/optimize/multi', methods=['POST'])
+async def optimize_queries():
+    """Endpoint to optimize several queries, answering those not found in history together."""
+    try:
+        data = await request.get_json()
+        
+        if not data or not isinstance(data.get('queries'), list) or not data['queries']:
+            return jsonify({"error": "Missing required field: queries"}), 400
+        if len(data['queries']) > MULTI_MAX_QUERIES:
+            return jsonify({"error": f"At most {MULTI_MAX_QUERIES} queries can be optimized at once"}), 413
+        
+        payloads = []
+        for index, item in enumerate(data['queries']):
+            try:
+                payloads.append(validate_optimize_request(item))
+            except RequestValidationError as e:
+                body = e.to_dict()
+                body["index"] = index
+                return jsonify(body), e.status_code
+        
+        # Answer repeated requests from the cache, as /api/optimize does
+        use_cache = request.args.get('cache', 'true').lower() != 'false'
+        cache_keys = [request_cache_key(payload) for payload in payloads]
+        results = [None] * len(payloads)
+        if use_cache:
+            for index, cache_key in enumerate(cache_keys):
+                cached = await result_cache.get(cache_key)
+                if cached is not None:
+                    results[index] = {**cached, "tokensUsed": 0}
+        
+        # Embed the rest in one call and look them up in history concurrently
+        pending = [index for index, result in enumerate(results) if result is None]
+        canonical_queries = await asyncio.to_thread(
+            lambda: [canonicalize_query(payloads[index].sqlQuery, payloads[index].databaseEngine) for index in pending]
+        )
+        query_embeddings = await try_create_query_embeddings(canonical_queries)
+        prepared = list(zip(canonical_queries, query_embeddings))
+        similar_optimizations = await asyncio.gather(
+            *(
+                find_similar_optimization(payloads[index], canonical_query, query_embedding)
+                for index, (canonical_query, query_embedding) in zip(pending, prepared)
+            )
+        )
+        
+        unanswered = []
+        matched = []
+        for index, (canonical_query, query_embedding), similar_optimization in zip(pending, prepared, similar_optimizations):
+            if similar_optimization:
+                results[index] = history_response(payloads[index].sqlQuery, similar_optimization)
+                matched.append((index, run_write(save_history_match, payloads[index], canonical_query, similar_optimization)))
+            else:
+                unanswered.append((index, canonical_query, query_embedding))
+        
+        # Save the history matches concurrently so they can share a group commit
+        await asyncio.gather(*(save for _, save in matched))
+        for index, _ in matched:
+            await result_cache.set(cache_keys[index], results[index])
+        
+        # Send the remaining requests to OpenAI in as few calls as the token budget allows
+        sections = [create_request_prompt(payloads[index]) for index, _, _ in unanswered]
+        groups = pack_prompt_sections(sections)
+        answers = await asyncio.gather(
+            *(get_optimizations_from_openai([sections[position] for position in group]) for group in groups)
+        )
+        
+        answered = []
+        for group, group_results in zip(groups, answers):
+            for position, optimization_result in zip(group, group_results):
+                index, canonical_query, query_embedding = unanswered[position]
+                optimization_result["originalQuery"] = payloads[index].sqlQuery
+                optimization_result["source"] = "openai"
+                results[index] = optimization_result
+                answered.append((index, save_optimization(payloads[index], canonical_query, optimization_result, query_embedding)))
+        
+        # Save the new optimizations concurrently, then cache the successfully parsed ones
+        saved = await asyncio.gather(*(save for _, save in answered))
+        for (index, _), (_, result_id) in zip(answered, saved):
+            results[index]["id"] = result_id
+            if "error" not in results[index]:
+                await result_cache.set(cache_keys[index], results[index])
+        
+        return jsonify({"results": results})
+        
+    except RequestValidationError as e:
+        return jsonify(e.to_dict()), e.status_code
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.exception("Error optimizing queries")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/feedback', methods=['POST'])
-def submit_feedback():
+async def submit_feedback():
     """Endpoint to submit feedback for an optimization."""
     try:
-        data = request.json
+        data = await request.get_json()
         
         if not data or 'id' not in data or 'feedback' not in data:
             return jsonify({"error": "Missing required fields: id, feedback"}), 400
@@ -247,371 +875,1220 @@ def submit_feedback():
         is_useful = feedback == 'helpful'
         
         # Save feedback in database
-        conn = get_db_connection()
+        feedback_id = await run_write(save_feedback, result_id, is_useful)
+        
+        return jsonify({"success": True, "id": feedback_id})
+
+    except Exception as e:
+        logger.exception("Error submitting feedback")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/optimize/batch', methods=['POST'])
+async def submit_batch_optimization():
+    """Endpoint to optimize many queries offline through the OpenAI Batch API."""
+    try:
+        data = await request.get_json()
+
+        if not data or not isinstance(data.get('queries'), list) or not data['queries']:
+            return jsonify({"error": "Missing required field: queries"}), 400
+
+        # Validate every query and build the same chat request the synchronous
+        # endpoint would send, before anything is uploaded
+        payloads = []
+        chat_requests = []
+        for index, item in enumerate(data['queries']):
+            try:
+                payload = validate_optimize_request(item)
+                chat_requests.append(build_chat_request(create_request_prompt(payload)))
+                payloads.append(payload)
+            except RequestValidationError as e:
+                body = e.to_dict()
+                body["index"] = index
+                return jsonify(body), e.status_code
+
+        batch_id = await submit_batch(client, chat_requests)
+
+        # Record the requests so the poller can store their results when the batch completes
+        await asyncio.to_thread(save_batch_job, batch_id, payloads)
+
+        return jsonify({"id": batch_id, "status": "submitted", "count": len(chat_requests)}), 202
+
+    except Exception as e:
+        logger.exception("Error submitting optimization batch")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/optimize/batch/<batch_id>', methods=['GET'])
+async def get_batch_optimization(batch_id):
+    """Endpoint to check a batch and stream its stored results once completed."""
+    try:
+        job = await asyncio.to_thread(get_batch_job, batch_id)
+        if job is None:
+            return jsonify({"error": "Batch not found"}), 404
+
+        # Check on the batch now rather than waiting for the next poll
+        if job['status'] not in FINAL_BATCH_STATUSES:
+            await collect_batch(batch_id, job['request_ids'])
+            job = await asyncio.to_thread(get_batch_job, batch_id)
+
+        if job['status'] != 'completed':
+            return jsonify({"id": batch_id, "status": job['status']})
+
+        optimizations = await asyncio.to_thread(get_latest_optimizations, job['request_ids'])
+
+        async def generate():
+            # One JSON object per line, in the order the queries were submitted
+            for custom_id, request_id in enumerate(job['request_ids']):
+                optimization = optimizations.get(request_id)
+                if optimization is None:
+                    result = {"error": job['errors'].get(str(request_id), "No result was returned for this query")}
+                else:
+                    result = {**history_response(optimization['original_query'], optimization), "source": "batch"}
+                result['customId'] = str(custom_id)
+                yield orjson.dumps(result) + b"\n"
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    except Exception as e:
+        logger.exception("Error retrieving optimization batch %s", batch_id)
+        return jsonify({"error": str(e)}), 500
+
+@app.before_serving
+async def start_batch_poller():
+    """Start storing the results of submitted batches in the background."""
+    app.batch_poller = asyncio.create_task(poll_batches())
+
+@app.after_serving
+async def stop_batch_poller():
+    app.batch_poller.cancel()
+
+async def poll_batches():
+    """Check unfinished batches every BATCH_POLL_INTERVAL seconds, storing completed results."""
+    while True:
+        try:
+            for batch_id, request_ids in await asyncio.to_thread(get_unfinished_batch_jobs):
+                await collect_batch(batch_id, request_ids)
+        except Exception:
+            logger.exception("Error polling optimization batches")
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+async def collect_batch(batch_id, request_ids):
+    """Update a batch's status and, once it has completed, store its results and embeddings."""
+    batch, lines = await retrieve_batch(client, batch_id)
+    if batch.status != 'completed':
+        await asyncio.to_thread(update_batch_status, batch_id, batch.status)
+        return
+    
+    # custom_id is the index of the query in the submitted batch. Requests that failed
+    # are recorded with their error instead of a result.
+    results = []
+    errors = {}
+    for line in lines:
+        custom_id, content, tokens_used, finish_reason, error = parse_batch_line(line)
+        request_id = request_ids[int(custom_id)]
+        if error:
+            errors[str(request_id)] = str(error)
+        else:
+            results.append((request_id, parse_optimization_response(content, tokens_used, finish_reason)))
+    
+    answered = {request_id for request_id, _ in results}
+    for request_id in request_ids:
+        if request_id not in answered:
+            errors.setdefault(str(request_id), "The batch returned no result for this request")
+    
+    # Workers may collect the same batch; only the first stores it
+    if not await asyncio.to_thread(save_batch_results, batch_id, results, errors):
+        return
+    logger.info("Stored %d results of batch %s", len(results), batch_id)
+    
+    # The results are usable without embeddings; backfill-embeddings can add them later
+    try:
+        queries = await asyncio.to_thread(get_canonical_queries, request_ids)
+        await embed_queries(queries)
+    except Exception:
+        logger.exception("Error embedding the queries of batch %s", batch_id)
+
+# Columns of a stored optimization read for history responses, in optimization_from_row
+# order. Suggestion arrays are read as their JSON text.
+OPTIMIZATION_COLUMNS = """
+    or2.result_id,
+    or2.request_id,
+    or2.optimized_query,
+    or2.optimization_explanation,
+    or2.suggested_indexes::text,
+    or2.suggested_schema_changes::text,
+    or2.suggested_server_configs::text,
+    or2.estimated_improvement,
+    qr.original_query
+"""
+
+def optimization_from_row(row):
+    """Build the dict history_response expects from a row of OPTIMIZATION_COLUMNS."""
+    (result_id, request_id, optimized_query, optimization_explanation, suggested_indexes,
+     suggested_schema_changes, suggested_server_configs, estimated_improvement, original_query) = row
+    return {
+        'result_id': result_id,
+        'request_id': request_id,
+        'optimized_query': optimized_query,
+        'optimization_explanation': optimization_explanation,
+        'suggested_indexes': suggested_indexes,
+        'suggested_schema_changes': suggested_schema_changes,
+        'suggested_server_configs': suggested_server_configs,
+        'estimated_improvement': estimated_improvement,
+        'original_query': original_query
+    }
+
+def history_response(sql_query, similar_optimization):
+    """Build the response for a query answered by an optimization found in history."""
+    # Suggestion arrays are read as their stored JSON text and written into the response
+    # as they are, instead of being decoded into lists only to be encoded again
+    return {
+        "originalQuery": sql_query,
+        "optimizedQuery": similar_optimization['optimized_query'],
+        "analysis": similar_optimization['optimization_explanation'],
+        "performanceImprovement": f"{similar_optimization['estimated_improvement']}%",
+        "indexSuggestions": json_fragment(similar_optimization['suggested_indexes']),
+        "structureSuggestions": json_fragment(similar_optimization['suggested_schema_changes']),
+        "serverSuggestions": json_fragment(similar_optimization['suggested_server_configs']),
+        "id": similar_optimization['result_id'],
+        "source": "history"
+    }
+
+def json_fragment(json_text):
+    """Wrap JSON text read from the database so orjson writes it into a response unchanged."""
+    return orjson.Fragment(json_text) if json_text is not None else None
+
+async def prepare_query(payload):
+    """Canonicalize a query and embed its canonical form.
+    
+    Returns (canonical_query, query_embedding).
+    """
+    canonical_query = await asyncio.to_thread(canonicalize_query, payload.sqlQuery, payload.databaseEngine)
+    query_embedding = await try_create_query_embedding(canonical_query)
+    return canonical_query, query_embedding
+
+async def save_optimization(payload, canonical_query, optimization_result, query_embedding):
+    """Save a query request with its optimization and embedding; returns (request_id, result_id)."""
+    # The embedding is regenerated only if it could not be computed earlier
+    if query_embedding is None:
+        query_embedding = await try_create_query_embedding(canonical_query)
+    
+    return await run_write(save_optimized_request, payload, canonical_query, optimization_result, query_embedding)
+
+async def run_write(write, *args):
+    """Run write(cursor, *args) through the group committer and return its result once committed."""
+    return await asyncio.wrap_future(group_committer.submit(write, *args))
+
+def save_optimized_request(cursor, payload, canonical_query, optimization_result, query_embedding):
+    """Save a query request, its optimization result and its embedding; returns (request_id, result_id)."""
+    request_id = save_query_request(cursor, payload, canonical_query)
+    result_id = save_optimization_result(cursor, request_id, optimization_result, 'gpt-4o')
+    # Continue without the embedding if it could not be generated
+    if query_embedding is not None:
+        save_query_vector(cursor, request_id, query_embedding)
+    return request_id, result_id
+
+def save_history_match(cursor, payload, canonical_query, similar_optimization):
+    """Save a query request answered from history and its similarity relationship; returns the request_id."""
+    request_id = save_query_request(cursor, payload, canonical_query)
+    save_similarity_relationship(
+        cursor,
+        request_id,
+        similar_optimization['request_id'],
+        similar_optimization['similarity_score'],
+        similar_optimization['similarity_type']
+    )
+    return request_id
+
+def save_batch_job(batch_id, payloads):
+    """Save the requests of a submitted batch and the job listing them, in one transaction."""
+    canonical_queries = [canonicalize_query(payload.sqlQuery, payload.databaseEngine) for payload in payloads]
+    
+    with db_conn() as conn:
         cursor = conn.cursor()
         
         try:
+            # Reserve the ids up front so they are known in submission order
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence('QueryRequests', 'request_id')) FROM generate_series(1, %s)",
+                (len(payloads),)
+            )
+            request_ids = [row[0] for row in cursor.fetchall()]
+            
+            execute_values(cursor, """
+                INSERT INTO QueryRequests
+                (request_id, original_query, table_structures, existing_indexes, performance_issues,
+                 explain_results, server_info, database_engine, database_version, database_size,
+                 canonical_query, canonical_hash, lsh_bands)
+                VALUES %s
+            """, [
+                (request_id, *query_request_row(payload, canonical_query))
+                for request_id, payload, canonical_query in zip(request_ids, payloads, canonical_queries)
+            ])
             cursor.execute(
-                "INSERT INTO Feedbacks (result_id, is_useful) VALUES (%s, %s) RETURNING feedback_id",
-                (result_id, is_useful)
+                "INSERT INTO BatchJobs (batch_id, status, request_ids) VALUES (%s, 'submitted', %s)",
+                (batch_id, request_ids)
             )
-            feedback_id = cursor.fetchone()[0]
             conn.commit()
         except Exception as e:
             conn.rollback()
             raise e
-        finally:
-            conn.close()
-        
-        return jsonify({"success": True, "id": feedback_id})
-        
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
 
-def save_query_request(original_query, table_structure, existing_indexes, 
-                      performance_issues, explain_results, server_info,
-                      database_engine, database_version, database_size):
-    """Save query request to database and return the request_id."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def save_batch_results(batch_id, results, errors):
+    """Save the (request_id, optimization_result) pairs and the errors of a completed batch and mark it completed.
     
-    try:
-        cursor.execute(
-            """
-            INSERT INTO QueryRequests 
-            (original_query, table_structures, existing_indexes, performance_issues, 
-             explain_results, server_info, database_engine, database_version, database_size) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING request_id
-            """,
-            (
-                original_query,
-                Json(table_structure) if table_structure else None,
-                Json(existing_indexes) if existing_indexes else None,
-                performance_issues,
-                Json(explain_results) if explain_results else None,
-                Json(server_info) if server_info else None,
-                database_engine,
-                database_version,
-                database_size
+    Returns False without saving anything if the batch was already completed.
+    """
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            # The row lock makes concurrent collectors of the same batch wait for each other
+            cursor.execute("SELECT status FROM BatchJobs WHERE batch_id = %s FOR UPDATE", (batch_id,))
+            if cursor.fetchone()[0] == 'completed':
+                conn.rollback()
+                return False
+            
+            execute_values(cursor, """
+                INSERT INTO OptimizationResults
+                (request_id, optimized_query, optimization_explanation, suggested_indexes,
+                 suggested_schema_changes, suggested_server_configs, estimated_improvement,
+                 tokens_used, model_used)
+                VALUES %s
+            """, [optimization_result_row(request_id, result, 'gpt-4o') for request_id, result in results])
+            cursor.execute(
+                "UPDATE BatchJobs SET status = 'completed', completed_at = CURRENT_TIMESTAMP, errors = %s WHERE batch_id = %s",
+                (Json(errors) if errors else None, batch_id)
             )
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+def update_batch_status(batch_id, status):
+    """Record the latest status of a batch that has not completed."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE BatchJobs SET status = %s WHERE batch_id = %s AND status <> 'completed'",
+            (status, batch_id)
         )
-        request_id = cursor.fetchone()[0]
         conn.commit()
-        return request_id
-    except Exception as e:
+
+def get_batch_job(batch_id):
+    """Return the status, request ids and request errors of a batch, or None if it is unknown."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, request_ids, errors::text FROM BatchJobs WHERE batch_id = %s", (batch_id,))
+        row = cursor.fetchone()
+        conn.rollback()  # Read-only; end the transaction before returning the connection
+        if row is None:
+            return None
+        status, request_ids, errors = row
+        return {'status': status, 'request_ids': request_ids, 'errors': orjson.loads(errors) if errors else {}}
+
+def get_unfinished_batch_jobs():
+    """Return (batch_id, request_ids) for every batch that may still change."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT batch_id, request_ids FROM BatchJobs WHERE status NOT IN %s ORDER BY created_at",
+            (FINAL_BATCH_STATUSES,)
+        )
+        rows = cursor.fetchall()
         conn.rollback()
-        raise e
-    finally:
-        conn.close()
+        return rows
+
+def get_canonical_queries(request_ids):
+    """Return (request_id, canonical_query) for the given requests."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT request_id, canonical_query FROM QueryRequests WHERE request_id = ANY(%s) ORDER BY request_id",
+            (request_ids,)
+        )
+        rows = cursor.fetchall()
+        conn.rollback()
+        return rows
+
+def save_feedback(cursor, result_id, is_useful):
+    """Save feedback for an optimization result and return the feedback_id."""
+    execute_prepared(cursor, "insert_feedback", (result_id, is_useful))
+    return cursor.fetchone()[0]
+
+def save_query_request(cursor, payload, canonical_query):
+    """Insert a query request with the given cursor and return the request_id."""
+    execute_prepared(cursor, "insert_query_request", query_request_row(payload, canonical_query))
+    return cursor.fetchone()[0]
+
+def query_request_row(payload, canonical_query):
+    """Return the QueryRequests column values for a request, in insert_query_request order."""
+    return (
+        payload.sqlQuery,
+        Json(payload.tableStructure) if payload.tableStructure else None,
+        Json(payload.existingIndexes) if payload.existingIndexes else None,
+        payload.performanceIssue,
+        Json(payload.explainResults) if payload.explainResults else None,
+        Json(payload.serverInfo) if payload.serverInfo else None,
+        payload.databaseEngine,
+        payload.databaseVersion,
+        payload.databaseSize,
+        canonical_query,
+        canonical_hash(canonical_query),
+        lsh_bands(canonical_query)
+    )
 
-def save_optimization_result(request_id, optimized_query, optimization_explanation,
-                           suggested_indexes, suggested_schema_changes, 
-                           suggested_server_configs, estimated_improvement,
-                           tokens_used, model_used):
-    """Save optimization result and return the result_id."""
+def save_optimization_result(cursor, request_id, optimization_result, model_used):
+    """Insert an optimization result with the given cursor and return the result_id."""
+    execute_prepared(
+        cursor,
+        "insert_optimization_result",
+        optimization_result_row(request_id, optimization_result, model_used)
+    )
+    return cursor.fetchone()[0]
+
+def optimization_result_row(request_id, optimization_result, model_used):
+    """Return the OptimizationResults column values for a result, in insert_optimization_result order."""
+    estimated_improvement = optimization_result.get('performanceImprovement', '')
     # Convert estimated_improvement to float if it's a string percentage
     if isinstance(estimated_improvement, str):
-        try:
-            # Extract numeric part from string like "Up to 75% faster"
-            estimated_improvement = float(estimated_improvement.split("%")[0].split()[-1])
-        except:
-            estimated_improvement = 0.0
+        match = IMPROVEMENT_PATTERN.search(estimated_improvement)
+        estimated_improvement = float(match.group(1)) if match else 0.0
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    suggested_indexes = optimization_result.get('indexSuggestions', [])
+    suggested_schema_changes = optimization_result.get('structureSuggestions', [])
+    suggested_server_configs = optimization_result.get('serverSuggestions', [])
+    return (
+        request_id,
+        optimization_result.get('optimizedQuery', ''),
+        optimization_result.get('analysis', ''),
+        Json(suggested_indexes) if suggested_indexes else None,
+        Json(suggested_schema_changes) if suggested_schema_changes else None,
+        Json(suggested_server_configs) if suggested_server_configs else None,
+        estimated_improvement,
+        optimization_result.get('tokensUsed', 0),
+        model_used
+    )
+
+def validate_optimize_request(data):
+    """Validate an optimization request body and return it as an OptimizeRequest."""
+    if not isinstance(data, dict) or 'sqlQuery' not in data:
+        raise RequestValidationError("Missing required field: sqlQuery", 400)
     
     try:
-        cursor.execute(
-            """
-            INSERT INTO OptimizationResults 
-            (request_id, optimized_query, optimization_explanation, suggested_indexes,
-             suggested_schema_changes, suggested_server_configs, estimated_improvement,
-             tokens_used, model_used) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING result_id
-            """,
-            (
-                request_id,
-                optimized_query,
-                optimization_explanation,
-                Json(suggested_indexes) if suggested_indexes else None,
-                Json(suggested_schema_changes) if suggested_schema_changes else None,
-                Json(suggested_server_configs) if suggested_server_configs else None,
-                estimated_improvement,
-                tokens_used,
-                model_used
-            )
-        )
-        result_id = cursor.fetchone()[0]
-        conn.commit()
-        return result_id
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
+        payload = OptimizeRequest.model_validate(data)
+    except ValidationError as e:
+        details = e.errors(include_url=False, include_input=False, include_context=False)
+        raise RequestValidationError("Invalid request", 422, details)
+    
+    # Reject oversized requests before they turn into an expensive prompt
+    if payload.total_size() > MAX_PROMPT_BYTES:
+        raise RequestValidationError(f"Request exceeds the maximum size of {MAX_PROMPT_BYTES} bytes", 413)
+    
+    return payload
+
+# Fields every optimization result must contain
+EXPECTED_STRING_FIELDS = ("optimizedQuery", "analysis", "performanceImprovement")
+EXPECTED_LIST_FIELDS = ("indexSuggestions", "structureSuggestions", "serverSuggestions")
+
+# Structured Outputs schema: in strict mode the model can only produce an object
+# with exactly these fields, so answers never need repairing or backfilling
+OPTIMIZATION_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{field: {"type": "string"} for field in EXPECTED_STRING_FIELDS},
+        **{field: {"type": "array", "items": {"type": "string"}} for field in EXPECTED_LIST_FIELDS}
+    },
+    "required": [*EXPECTED_STRING_FIELDS, *EXPECTED_LIST_FIELDS],
+    "additionalProperties": False
+}
+
+OPTIMIZATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "OptimizationResult",
+        "strict": True,
+        "schema": OPTIMIZATION_RESULT_SCHEMA
+    }
+}
+
+# Schema for several requests answered in one completion, each result tagged with
+# the number of the request it answers
+MULTI_OPTIMIZATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "OptimizationResults",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "optimizations": {
+                    "type": "array",
+                    "items": {
+                        **OPTIMIZATION_RESULT_SCHEMA,
+                        "properties": {"queryIndex": {"type": "integer"}, **OPTIMIZATION_RESULT_SCHEMA["properties"]},
+                        "required": ["queryIndex", *OPTIMIZATION_RESULT_SCHEMA["required"]]
+                    }
+                }
+            },
+            "required": ["optimizations"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Review checklist included in every system message, so answers are consistent and
+# grounded in the request's context
+OPTIMIZATION_GUIDELINES = """Work through the following checklist before answering.
+
+Query rewrites
+- The optimized query must return exactly the same rows as the original, including NULL handling, duplicate rows and ordering where ORDER BY is present. Never change the meaning of a query to make it faster.
+- Replace SELECT * with the columns that are needed when the table structure makes them clear.
+- Make predicates sargable: do not wrap indexed columns in functions or arithmetic, avoid implicit type conversions between columns and values, avoid leading wildcards in LIKE, and express date filters as half-open ranges on the raw column.
+- Prefer EXISTS or joins over IN with a subquery where the engine plans it poorly, and point out NOT IN over a nullable column, which returns no rows when the subquery yields a NULL.
+- Replace correlated subqueries that run once per row with joins, derived tables or window functions.
+- Filter and aggregate before joining where possible, and do not use DISTINCT to hide rows multiplied by a join.
+- Use UNION ALL instead of UNION when duplicates are impossible or acceptable.
+- For deep pagination, recommend keyset pagination on an indexed column instead of large OFFSET values.
+- Only split OR conditions over different columns into UNION ALL branches when each branch can use an index.
+
+Engine and version
+- Only use syntax and features supported by the given database engine and version, for example common table expressions and window functions only from MySQL 8.0, invisible indexes and descending indexes only from MySQL 8.0, and INCLUDE columns only from PostgreSQL 11.
+- When no version is given, assume a currently supported release and say which features the suggestions rely on.
+- Take the database size and the server information into account when weighing a suggestion's benefit against its cost.
+
+Indexes
+- Derive index suggestions from the WHERE, JOIN, GROUP BY and ORDER BY clauses: equality columns first, then at most one range column, then the sort columns. Add selected columns to make a covering index only when they are few and narrow.
+- Compare against the existing indexes: never suggest an index that duplicates an existing one or is a left prefix of one, and point out existing indexes that are redundant.
+- Use the record counts to judge selectivity; an index on a low-cardinality column alone rarely helps.
+- Mention the write and storage cost of new indexes on large or write-heavy tables.
+- Write every index suggestion as a complete, valid CREATE INDEX statement for the given engine and version, with a descriptive index name.
+
+Reading EXPLAIN output
+- MySQL: access type ALL or index means a full scan. Check key, rows and filtered, and Extra values such as Using filesort, Using temporary and Using join buffer. With EXPLAIN ANALYZE, compare estimated and actual rows.
+- PostgreSQL: look for sequential scans of large tables, row estimates far from actual rows, sorts or hashes spilling to disk, and nested loops over large inputs.
+- Tie each finding in the analysis to the plan row or the clause it comes from.
+
+Schema changes
+- Only suggest structural changes that address the problem at hand: suitable data types and lengths, identical types on both sides of a join, normalization or targeted denormalization, partitioning of very large time-based tables, and generated columns to index expressions.
+- Say when a change requires a migration that rewrites or locks a large table.
+
+Server configuration
+- Only suggest settings related to the observed problem and the server information given, such as buffer pool or shared_buffers size relative to RAM, sort and join buffer sizes, temporary table limits, work_mem, refreshing table statistics, and the slow query log to verify the improvement.
+- Give concrete values and the reasoning behind them. Say so explicitly whenever a setting trades durability or consistency for speed.
+
+Estimating the improvement
+- Be conservative. Base the estimate on the scans, sorts and temporary tables the changes remove, and use "0" when the query is already optimal.
+- If the query is already well optimized, return it unchanged, say so in the analysis, and leave the suggestion arrays empty rather than inventing changes.
+
+Answer format
+- The optimized query contains only SQL, without markdown fences or commentary.
+- The analysis is plain text and covers the most significant problems first.
+- Each entry of a suggestion array is one self-contained suggestion.
+
+"""
+
+# Response requirements for a single request
+OPTIMIZATION_REQUIREMENTS = """Please provide a complete response to the user's request in JSON format with the following fields:
+1. "optimizedQuery": The optimized SQL query
+2. "analysis": Detailed analysis of performance issues in the original query
+3. "performanceImprovement": Estimated performance improvement percentage (e.g., "75")
+4. "indexSuggestions": Array of suggested indexes to add
+5. "structureSuggestions": Array of suggested table structure improvements
+6. "serverSuggestions": Array of server configuration suggestions
+
+Format your response as a valid JSON object."""
+
+# The same requirements for several numbered requests answered together
+MULTI_OPTIMIZATION_REQUIREMENTS = """Please provide a complete response to each of the numbered requests in the user's message in JSON format. Return an object whose "optimizations" array holds one entry per request, each with the following fields:
+1. "queryIndex": The number of the request being answered
+2. "optimizedQuery": The optimized SQL query
+3. "analysis": Detailed analysis of performance issues in the original query
+4. "performanceImprovement": Estimated performance improvement percentage (e.g., "75")
+5. "indexSuggestions": Array of suggested indexes to add
+6. "structureSuggestions": Array of suggested table structure improvements
+7. "serverSuggestions": Array of server configuration suggestions
+
+Format your response as a valid JSON object."""
+
+# System messages hold every static instruction, so the user message is only the request.
+# OpenAI caches repeated prompt prefixes of 1024 tokens or more, which these exceed, so
+# their tokens are billed at the cached rate and not processed again. Keep them unchanged
+# between requests.
+OPTIMIZATION_ROLE = "You are a database optimization expert with deep knowledge of SQL performance tuning. Respond only with valid JSON.\n\n"
+SYSTEM_MESSAGE = OPTIMIZATION_ROLE + OPTIMIZATION_GUIDELINES + OPTIMIZATION_REQUIREMENTS
+MULTI_SYSTEM_MESSAGE = OPTIMIZATION_ROLE + OPTIMIZATION_GUIDELINES + MULTI_OPTIMIZATION_REQUIREMENTS
+
+def format_context(value):
+    """Render a context field for the prompt: text as-is, JSON indented by orjson."""
+    if isinstance(value, str):
+        return value
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2).decode('utf-8')
 
 def create_optimization_prompt(sql_query, table_structure, existing_indexes, 
                               performance_issue, explain_results, server_info,
                               database_engine, database_version):
     """Create a detailed prompt for OpenAI to optimize the query."""
-    prompt = f"""I need to optimize the following {database_engine} query:
-
-```sql
-{sql_query}
-```
-
-"""
+    # Collect the sections and join once at the end instead of growing a string
+    parts = [
+        f"I need to optimize the following {database_engine} query:\n\n```sql\n{sql_query}\n```\n\n"
+    ]
 
     # Add additional information if available
     if table_structure:
-        prompt += f"\nTable structure and record counts:\n{json.dumps(table_structure, indent=2)}\n"
+        parts.append(f"\nTable structure and record counts:\n{format_context(table_structure)}\n")
     
     if existing_indexes:
-        prompt += f"\nExisting indexes:\n{json.dumps(existing_indexes, indent=2)}\n"
+        parts.append(f"\nExisting indexes:\n{format_context(existing_indexes)}\n")
     
     if performance_issue:
-        prompt += f"\nCurrent performance issues:\n{performance_issue}\n"
+        parts.append(f"\nCurrent performance issues:\n{performance_issue}\n")
     
     if explain_results:
-        prompt += f"\nEXPLAIN results:\n{json.dumps(explain_results, indent=2)}\n"
+        parts.append(f"\nEXPLAIN results:\n{format_context(explain_results)}\n")
     
     if server_info:
-        prompt += f"\nDatabase server information:\n{json.dumps(server_info, indent=2)}\n"
+        parts.append(f"\nDatabase server information:\n{format_context(server_info)}\n")
     
     if database_engine and database_version:
-        prompt += f"\nDatabase engine: {database_engine} {database_version}\n"
+        parts.append(f"\nDatabase engine: {database_engine} {database_version}\n")
+
+    return "".join(parts)
+
+# Appended to context fields that were clipped to fit the token budget
+TRUNCATION_MARKER = "\n... [truncated]"
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens tokens, marking that it was truncated."""
+    tokens = token_encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    keep = max(max_tokens - len(token_encoding.encode(TRUNCATION_MARKER)), 0)
+    return token_encoding.decode(tokens[:keep]) + TRUNCATION_MARKER
+
+def create_request_prompt(payload):
+    """Create the optimization prompt for a validated request, clipped to the token budget."""
+    # Each pass clips the largest context field by the number of tokens over budget
+    for _ in range(2 * len(TRUNCATABLE_FIELDS)):
+        prompt = create_optimization_prompt(
+            payload.sqlQuery,
+            payload.tableStructure,
+            payload.existingIndexes,
+            payload.performanceIssue,
+            payload.explainResults,
+            payload.serverInfo,
+            payload.databaseEngine,
+            payload.databaseVersion
+        )
+        excess = len(token_encoding.encode(prompt)) - PROMPT_TOKEN_BUDGET
+        if excess <= 0:
+            return prompt
+        
+        field = max(TRUNCATABLE_FIELDS, key=lambda name: context_size(getattr(payload, name)))
+        value = getattr(payload, field)
+        if not value:
+            break
+        
+        text = format_context(value)
+        keep = max(len(token_encoding.encode(text)) - excess, 0)
+        logger.warning("Prompt is %s tokens over budget, truncating %s to %s tokens", excess, field, keep)
+        payload = payload.model_copy(update={field: truncate_to_tokens(text, keep)})
     
-    # Add requirements for the optimization
-    prompt += """
-Please provide a complete response in JSON format with the following fields:
-1. "optimizedQuery": The optimized SQL query
-2. "analysis": Detailed analysis of performance issues in the original query
-3. "performanceImprovement": Estimated performance improvement percentage (e.g., "75")
-4. "indexSuggestions": Array of suggested indexes to add
-5. "structureSuggestions": Array of suggested table structure improvements
-6. "serverSuggestions": Array of server configuration suggestions
-7. "tokensUsed": Leave this as 0, it will be filled in by the system
+    raise RequestValidationError(f"Request exceeds the prompt budget of {PROMPT_TOKEN_BUDGET} tokens", 413)
 
-Format your response as a valid JSON object."""
+def create_multi_optimization_prompt(sections):
+    """Create one prompt holding several numbered requests."""
+    parts = []
+    for number, section in enumerate(sections, 1):
+        parts.append(f"-- Request {number} --\n{section}\n")
+    return "".join(parts)
+
+def pack_prompt_sections(sections):
+    """Group request prompts into batches that fit MULTI_PROMPT_TOKEN_BUDGET; returns lists of indexes."""
+    groups = []
+    group_tokens = 0
+    for index, section in enumerate(sections):
+        tokens = len(token_encoding.encode(section))
+        # A request too large to share a call is sent on its own
+        if not groups or len(groups[-1]) >= MULTI_MAX_QUERIES_PER_CALL or group_tokens + tokens > MULTI_PROMPT_TOKEN_BUDGET:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(index)
+        group_tokens += tokens
+    return groups
+
+def build_chat_request(prompt, system_message=SYSTEM_MESSAGE,
+                       response_format=OPTIMIZATION_RESPONSE_FORMAT, max_tokens=COMPLETION_MAX_TOKENS):
+    """Build the chat completion request body used to optimize a query."""
+    return {
+        "model": "gpt-4o",  # Using the latest model
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.1,  # Lower temperature for more deterministic responses
+        "max_tokens": max_tokens,  # Bound the cost and latency of each answer
+        "response_format": response_format,  # Constrain the model to the result schema
+    }
+
+def check_completion(content, finish_reason):
+    """Raise ValueError for a completion that can't hold a complete answer."""
+    # Structured Outputs return a bare object with every field, so an answer can be parsed
+    # directly unless the model refused or was cut off at max_tokens
+    if content is None:
+        raise ValueError("The model refused to answer")
+    if finish_reason == "length":
+        raise ValueError("The answer was cut off at the completion token limit")
+
+def parse_optimization_response(content, tokens_used, finish_reason=None):
+    """Parse the model's JSON answer into an optimization result."""
+    try:
+        check_completion(content, finish_reason)
+        
+        result = orjson.loads(content)
+        result["tokensUsed"] = tokens_used
+        return result
+        
+    except ValueError as e:
+        logger.warning("Unusable optimization response: %s\nRaw response: %s", e, content)
+        return unparsable_result(e, tokens_used)
+
+def parse_multi_optimization_response(content, tokens_used, count, finish_reason=None):
+    """Parse the model's answer to several numbered requests into one result per request."""
+    # Token usage is only reported for the whole call, so each request gets an equal share
+    share = tokens_used // count
+    try:
+        check_completion(content, finish_reason)
+        
+        answers = {}
+        for result in orjson.loads(content)["optimizations"]:
+            result["tokensUsed"] = share
+            answers[result.pop("queryIndex")] = result
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Unusable optimization response: %s\nRaw response: %s", e, content)
+        return [unparsable_result(e, share) for _ in range(count)]
+    
+    return [
+        answers.get(number) or unparsable_result(f"no answer for request {number}", share)
+        for number in range(1, count + 1)
+    ]
+
+def unparsable_result(error, tokens_used):
+    """Fallback result returned when the model's answer can't be used."""
+    return {
+        "error": f"Invalid optimization response: {str(error)}",
+        "optimizedQuery": "Error parsing optimization response",
+        "analysis": "The AI response could not be parsed. Please try again with more specific details.",
+        "performanceImprovement": "0",
+        "indexSuggestions": [],
+        "structureSuggestions": [],
+        "serverSuggestions": [],
+        "tokensUsed": tokens_used
+    }
+
+def unavailable_result(error):
+    """Fallback result returned when OpenAI could not be reached."""
+    return {
+        "error": str(error),
+        "optimizedQuery": "Error contacting optimization service",
+        "analysis": "There was an error connecting to the optimization service. Please check your API key and try again.",
+        "performanceImprovement": "0",
+        "indexSuggestions": [],
+        "structureSuggestions": [],
+        "serverSuggestions": [],
+        "tokensUsed": 0
+    }
+
+@retry(
+    wait=wait_exponential(multiplier=1, max=20),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+async def call_openai(prompt, **options):
+    """Send the chat completion request, retrying transient errors with backoff."""
+    chat_request = build_chat_request(prompt, **options)
+    await throttle_openai(chat_request)
+    # Only hold a slot while the request is in flight, not while backing off
+    async with openai_semaphore:
+        return await client.chat.completions.create(**chat_request)
+
+async def throttle_openai(chat_request):
+    """Wait until a chat request fits under the configured OPENAI_RPM_LIMIT and OPENAI_TPM_LIMIT."""
+    if openai_request_limiter:
+        await openai_request_limiter.acquire()
+    if openai_token_limiter:
+        # OpenAI counts the prompt and the largest possible answer against the TPM limit
+        tokens = sum(len(token_encoding.encode(message["content"])) for message in chat_request["messages"])
+        tokens += chat_request["max_tokens"]
+        # A single request larger than the whole minute's budget may still go alone
+        await openai_token_limiter.acquire(min(tokens, openai_token_limiter.max_rate))
+
+# sqlglot dialect used to parse queries for each database engine; anything else is read as MySQL
+SQL_DIALECTS = {
+    "mysql": "mysql",
+    "mariadb": "mysql",
+    "postgresql": "postgres",
+    "postgres": "postgres",
+    "sqlite": "sqlite",
+    "sql server": "tsql",
+    "oracle": "oracle"
+}
+
+def canonicalize_query(sql_query, database_engine="MySQL"):
+    """Return the canonical form of a query for similarity search.
+    
+    Formatting, keyword and identifier case, and compared literal values are normalized
+    away, so queries that differ only in those compare as equal.
+    """
+    dialect = SQL_DIALECTS.get((database_engine or "").lower(), "mysql")
+    try:
+        statements = [tree for tree in sqlglot.parse(sql_query, read=dialect) if tree is not None]
+    except (sqlglot.errors.SqlglotError, RecursionError):
+        # Not parseable in this dialect, so only normalize whitespace and case
+        return normalize_sql(sql_query).lower()
+    
+    for tree in statements:
+        for literal in list(tree.find_all(exp.Literal)):
+            if not is_structural_literal(literal):
+                literal.replace(exp.Placeholder())
+    return "; ".join(tree.sql(dialect=dialect, normalize=True) for tree in statements).lower()
+
+def query_literals(sql_query, database_engine="MySQL"):
+    """Return the compared literal values that canonicalize_query replaces, or None if the query can't be parsed."""
+    dialect = SQL_DIALECTS.get((database_engine or "").lower(), "mysql")
+    try:
+        statements = [tree for tree in sqlglot.parse(sql_query, read=dialect) if tree is not None]
+    except (sqlglot.errors.SqlglotError, RecursionError):
+        return None
+    
+    return [
+        (literal.is_string, literal.this)
+        for tree in statements
+        for literal in tree.find_all(exp.Literal)
+        if not is_structural_literal(literal)
+    ]
 
-    return prompt
+def is_structural_literal(literal):
+    """Whether a literal changes what a query returns rather than being a compared value.
+    
+    Row limits and offsets, and ORDER BY or GROUP BY column positions, are kept in the
+    canonical form so that, for example, LIMIT 10 and LIMIT 100000 stay different queries.
+    """
+    parent = literal.parent
+    if isinstance(parent, (exp.Limit, exp.Offset, exp.Fetch, exp.Group)):
+        return True
+    return isinstance(parent, exp.Ordered) and literal.arg_key == "this" and isinstance(parent.parent, exp.Order)
+
+def normalize_sql(sql_query):
+    """Collapse whitespace in a SQL query so formatting differences share cache entries."""
+    return " ".join(sql_query.split())
+
+def canonical_hash(canonical_query):
+    """Return the 16-byte hash of a canonical query stored in QueryRequests.canonical_hash."""
+    return hashlib.blake2b(canonical_query.encode("utf-8"), digest_size=16).digest()
+
+def request_cache_key(payload):
+    """Return the result cache key for a validated request."""
+    fields = payload.model_dump()
+    fields["sqlQuery"] = normalize_sql(payload.sqlQuery)
+    return hashlib.blake2b(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
 
-def get_optimization_from_openai(prompt):
+async def get_optimization_from_openai(prompt, sql_query):
     """Call OpenAI API to optimize the query."""
     try:
         # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-4o",  # Using the latest model
-            messages=[
-                {"role": "system", "content": "You are a database optimization expert with deep knowledge of SQL performance tuning. Respond only with valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,  # Lower temperature for more deterministic responses
-        )
+        response = await call_openai(prompt)
         
         # Extract the content from the response
-        content = response.choices[0].message.content
+        choice = response.choices[0]
         tokens_used = response.usage.total_tokens
 
-        # Try to parse the JSON response
-        try:
-            # Extract JSON if it's wrapped in markdown code blocks
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-            
-            result = json.loads(content)
-            
-            # Add the original query to the result
-            result["originalQuery"] = prompt.split("```sql")[1].split("```")[0].strip()
-            result["tokensUsed"] = tokens_used
-            
-            # Ensure all expected fields exist
-            expected_fields = ["optimizedQuery", "analysis", "performanceImprovement", 
-                              "indexSuggestions", "structureSuggestions", "serverSuggestions"]
-            
-            for field in expected_fields:
-                if field not in result:
-                    if field in ["indexSuggestions", "structureSuggestions", "serverSuggestions"]:
-                        result[field] = []
-                    else:
-                        result[field] = ""
-            
-            return result
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {str(e)}")
-            print(f"Raw response: {content}")
-            
-            # Fallback response if JSON parsing fails
-            return {
-                "originalQuery": prompt.split("```sql")[1].split("```")[0].strip(),
-                "optimizedQuery": "Error parsing optimization response",
-                "analysis": "The AI response could not be parsed. Please try again with more specific details.",
-                "performanceImprovement": "0",
-                "indexSuggestions": [],
-                "structureSuggestions": [],
-                "serverSuggestions": [],
-                "tokensUsed": tokens_used
-            }
+        result = parse_optimization_response(choice.message.content, tokens_used, choice.finish_reason)
+        
+        # Add the original query to the result
+        result["originalQuery"] = sql_query
+        return result
             
     except Exception as e:
-        print(f"OpenAI API error: {str(e)}")
-        return {
-            "error": str(e),
-            "originalQuery": prompt.split("```sql")[1].split("```")[0].strip(),
-            "optimizedQuery": "Error contacting optimization service",
-            "analysis": "There was an error connecting to the optimization service. Please check your API key and try again.",
-            "performanceImprovement": "0",
-            "indexSuggestions": [],
-            "structureSuggestions": [],
-            "serverSuggestions": [],
-            "tokensUsed": 0
-        }
+        logger.exception("OpenAI API error")
+        return {**unavailable_result(e), "originalQuery": sql_query}
 
-def save_query_embedding(request_id, query):
-    """Generate and save embedding for a query."""
+async def get_optimizations_from_openai(sections):
+    """Optimize several requests with one OpenAI call; returns a result per request prompt."""
     try:
-        # Generate embedding using OpenAI
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=query
+        response = await call_openai(
+            create_multi_optimization_prompt(sections),
+            system_message=MULTI_SYSTEM_MESSAGE,
+            response_format=MULTI_OPTIMIZATION_RESPONSE_FORMAT,
+            max_tokens=min(COMPLETION_MAX_TOKENS * len(sections), MODEL_MAX_COMPLETION_TOKENS)  # Room for every answer
+        )
+        choice = response.choices[0]
+        return parse_multi_optimization_response(
+            choice.message.content, response.usage.total_tokens, len(sections), choice.finish_reason
+        )
+    except Exception as e:
+        logger.exception("OpenAI API error")
+        return [unavailable_result(e) for _ in sections]
+
+async def create_query_embedding(query):
+    """Generate an embedding for a query, reusing it for repeated queries."""
+    cache_key = normalize_sql(query)
+    embedding = embedding_cache.get(cache_key)
+    if embedding is None:
+        if EMBEDDING_BACKEND == "fastembed":
+            # CPU-bound inference, kept off the event loop
+            embedding = await asyncio.to_thread(embed_locally, query)
+        else:
+            response = await client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=query,
+                dimensions=EMBEDDING_DIMENSIONS
+            )
+            embedding = np.array(response.data[0].embedding, dtype=np.float32)
+        embedding_cache[cache_key] = embedding
+    return embedding
+
+@functools.cache
+def get_local_embedding_model():
+    """Load the fastembed model on first use.
+    
+    ONNX Runtime sessions don't survive a fork, so each worker loads its own rather
+    than inheriting one from a preloading Gunicorn master.
+    """
+    return TextEmbedding(model_name=EMBEDDING_MODEL)
+
+def embed_locally(query):
+    """Embed a query with the local fastembed model."""
+    return next(iter(get_local_embedding_model().embed([query]))).astype(np.float32)
+
+async def create_query_embeddings(queries):
+    """Generate embeddings for many queries in a single call, bypassing the cache."""
+    if EMBEDDING_BACKEND == "fastembed":
+        return await asyncio.to_thread(
+            lambda: [embedding.astype(np.float32) for embedding in get_local_embedding_model().embed(queries)]
         )
-        embedding = response.data[0].embedding
+    
+    response = await client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=queries,
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [np.array(item.embedding, dtype=np.float32) for item in response.data]
+
+async def try_create_query_embedding(query):
+    """Generate an embedding for a query, returning None if OpenAI fails."""
+    try:
+        return await create_query_embedding(query)
+    except Exception:
+        logger.exception("Error generating query embedding")
+        return None
+
+async def try_create_query_embeddings(queries):
+    """Generate embeddings for many queries, embedding those not cached in a single call.
+    
+    Returns None in place of every uncached embedding if OpenAI fails.
+    """
+    cache_keys = [normalize_sql(query) for query in queries]
+    embeddings = [embedding_cache.get(cache_key) for cache_key in cache_keys]
+    missing = [index for index, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        try:
+            created = await create_query_embeddings([queries[index] for index in missing])
+        except Exception:
+            logger.exception("Error generating query embeddings")
+            return embeddings
+        for index, embedding in zip(missing, created):
+            embeddings[index] = embedding
+            embedding_cache[cache_keys[index]] = embedding
+    return embeddings
+
+def save_query_vector(cursor, request_id, embedding):
+    """Insert a query embedding with the given cursor and return the vector_id."""
+    execute_prepared(cursor, "insert_query_vector", (request_id, np.array(embedding)))
+    return cursor.fetchone()[0]
+
+async def backfill_query_embeddings(batch_size=EMBEDDING_BACKFILL_BATCH_SIZE):
+    """Embed the canonical form of every stored query without an embedding; returns how many were written."""
+    count = 0
+    while True:
+        pending = await asyncio.to_thread(fetch_unembedded_queries, batch_size)
+        if not pending:
+            return count
         
-        # Save embedding to database
-        conn = get_db_connection()
+        await embed_queries(pending, batch_size)
+        count += len(pending)
+
+async def embed_queries(queries, batch_size=EMBEDDING_BACKFILL_BATCH_SIZE):
+    """Embed (request_id, canonical_query) pairs batch_size at a time and bulk-insert the embeddings."""
+    for start in range(0, len(queries), batch_size):
+        chunk = queries[start:start + batch_size]
+        embeddings = await create_query_embeddings([query for _, query in chunk])
+        await asyncio.to_thread(
+            copy_query_vectors,
+            [(request_id, embedding) for (request_id, _), embedding in zip(chunk, embeddings)]
+        )
+
+def fetch_unembedded_queries(limit):
+    """Return (request_id, canonical_query) for up to limit stored queries without an embedding."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT qr.request_id, COALESCE(qr.canonical_query, qr.original_query)
+            FROM QueryRequests qr
+            WHERE NOT EXISTS (SELECT 1 FROM QueryVectors qv WHERE qv.request_id = qr.request_id)
+            ORDER BY qr.request_id
+            LIMIT %s
+        """, (limit,))
+        rows = cursor.fetchall()
+        conn.rollback()  # Read-only; end the transaction before returning the connection
+        return rows
+
+# Signature, flags and header extension length that open a binary COPY stream
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+
+def encode_query_vectors(rows):
+    """Encode (request_id, embedding) rows as a binary COPY stream for QueryVectors.
+    
+    Each embedding is sent in pgvector's halfvec wire format (int16 dimensions, int16
+    unused, then big-endian float16 values), so the server never parses vector text.
+    """
+    buffer = io.BytesIO()
+    buffer.write(COPY_BINARY_HEADER)
+    for request_id, embedding in rows:
+        values = np.asarray(embedding, dtype=">f2")
+        buffer.write(struct.pack("!hii", 2, 4, request_id))
+        buffer.write(struct.pack("!ihh", 4 + values.nbytes, len(values), 0))
+        buffer.write(values.tobytes())
+    buffer.write(struct.pack("!h", -1))
+    buffer.seek(0)
+    return buffer
+
+def copy_query_vectors(rows):
+    """Bulk-insert (request_id, embedding) rows into QueryVectors with one binary COPY."""
+    with db_conn() as conn:
         cursor = conn.cursor()
         
         try:
-            cursor.execute(
-                "INSERT INTO QueryVectors (request_id, embedding) VALUES (%s, %s) RETURNING vector_id",
-                (request_id, embedding)
+            cursor.copy_expert(
+                "COPY QueryVectors (request_id, embedding) FROM STDIN WITH (FORMAT BINARY)",
+                encode_query_vectors(rows)
             )
-            vector_id = cursor.fetchone()[0]
             conn.commit()
-            return vector_id
         except Exception as e:
             conn.rollback()
             raise e
-        finally:
-            conn.close()
-    except Exception as e:
-        print(f"Error generating or saving embedding: {str(e)}")
-        # Continue even if embedding fails
-        return None
 
-def find_similar_optimization(query, current_request_id, similarity_threshold=0.7):
+async def find_similar_optimization(payload, query, query_embedding, similarity_threshold=0.7):
     """Find a similar optimization in history with positive feedback."""
     try:
-        # Generate embedding for the query
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=query
+        # Search for similar queries with positive feedback
+        return await asyncio.to_thread(
+            search_similar_optimization, payload, query, query_embedding, similarity_threshold
         )
-        query_embedding = response.data[0].embedding
+    except Exception:
+        logger.exception("Error finding similar optimization")
+        return None
+
+def search_similar_optimization(payload, query, query_embedding, similarity_threshold):
+    """Search history for a positively rated optimization similar to the query, recording how it was matched."""
+    with db_conn() as conn:
+        cursor = conn.cursor()
         
-        # Search for similar queries with positive feedback
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=DictCursor)
-        
-        # First check if there's a direct string similarity match
-        direct_matches = find_direct_string_matches(conn, query, similarity_threshold)
-        if direct_matches:
-            for match in direct_matches:
-                # Check if this match has positive feedback
-                if has_positive_feedback(conn, match['request_id']):
-                    # Get the latest optimization result for this request
-                    optimization = get_latest_optimization(conn, match['request_id'])
-                    if optimization:
-                        optimization['similarity_score'] = match['similarity_score']
-                        conn.close()
-                        return optimization
+        # Most repeats differ only in formatting, case or literals, so they share the
+        # canonical query and are found without any similarity search
+        exact_match = find_exact_match(conn, payload, query)
+        if exact_match:
+            return exact_match
+        
+        # Then check if there's a direct string similarity match
+        string_match = find_string_match(conn, query, similarity_threshold)
+        if string_match:
+            return string_match
         
         # If no direct match, try vector similarity search
+        if query_embedding is None:
+            return None
+        
         try:
-            # Using PostgreSQL vector extension to find similar query embeddings
-            cursor.execute("""
-                SELECT qv.request_id, qv.vector_id, qv.embedding <=> %s AS similarity_score
-                FROM QueryVectors qv
-                ORDER BY similarity_score
-                LIMIT 5
-            """, (query_embedding,))
+            # Using the HNSW index on QueryVectors to find the nearest query embeddings, then
+            # keep those close enough that have positive feedback, with their latest
+            # optimization, all in one round-trip
+            cursor.execute("SET LOCAL hnsw.ef_search = 40")
+            cursor.execute(f"""
+                WITH candidates AS (
+                    SELECT qv.request_id, qv.embedding <=> %s::halfvec AS distance
+                    FROM QueryVectors qv
+                    ORDER BY distance
+                    LIMIT 5
+                ),
+                latest AS (
+                    SELECT DISTINCT ON (or2.request_id) or2.result_id, c.distance
+                    FROM candidates c
+                    JOIN OptimizationResults or2 ON or2.request_id = c.request_id
+                    WHERE c.distance <= %s
+                    ORDER BY or2.request_id, or2.created_at DESC
+                )
+                SELECT {OPTIMIZATION_COLUMNS}, l.distance
+                FROM latest l
+                JOIN OptimizationResults or2 ON or2.result_id = l.result_id
+                JOIN QueryRequests qr ON qr.request_id = or2.request_id
+                WHERE EXISTS (
+                    SELECT 1
+                    FROM OptimizationResults r
+                    JOIN Feedbacks f ON f.result_id = r.result_id
+                    WHERE r.request_id = or2.request_id AND f.is_useful
+                )
+                ORDER BY l.distance
+                LIMIT 1
+            """, (query_embedding, 1.0 - similarity_threshold))
             
-            similar_vectors = cursor.fetchall()
-            
-            # Check each similar vector for positive feedback
-            for vector in similar_vectors:
-                similarity_score = 1.0 - float(vector['similarity_score'])  # Convert distance to similarity
-                if similarity_score >= similarity_threshold:
-                    # Check if this query has positive feedback
-                    if has_positive_feedback(conn, vector['request_id']):
-                        # Get the latest optimization result for this request
-                        optimization = get_latest_optimization(conn, vector['request_id'])
-                        if optimization:
-                            optimization['similarity_score'] = similarity_score
-                            conn.close()
-                            return optimization
+            row = cursor.fetchone()
+            if row:
+                *columns, distance = row
+                optimization = optimization_from_row(columns)
+                optimization['similarity_score'] = 1.0 - float(distance)  # Convert distance to similarity
+                optimization['similarity_type'] = "vector_similarity"
+                return optimization
         except Exception as e:
-            print(f"Vector similarity search error: {str(e)}")
+            logger.warning("Vector similarity search error: %s", e)
             # Fall back to other methods if vector search fails
         
-        conn.close()
         return None
-    except Exception as e:
-        print(f"Error finding similar optimization: {str(e)}")
+
+
+def find_exact_match(conn, payload, query):
+    """Find the latest optimization of a positively rated request with the same canonical query.
+    
+    It only counts as an exact match when the compared literals are the same as well.
+    Otherwise the stored optimization may still name the other values, so it is scored
+    by how similar the two queries are as written.
+    """
+    cursor = conn.cursor()
+    # The canonical_hash index narrows this to the few requests for the same query
+    cursor.execute(f"""
+        SELECT {OPTIMIZATION_COLUMNS}
+        FROM QueryRequests qr
+        JOIN OptimizationResults or2 ON or2.request_id = qr.request_id
+        WHERE qr.canonical_hash = %s AND EXISTS (
+            SELECT 1
+            FROM OptimizationResults r
+            JOIN Feedbacks f ON f.result_id = r.result_id
+            WHERE r.request_id = qr.request_id AND f.is_useful
+        )
+        ORDER BY qr.request_id DESC, or2.created_at DESC
+        LIMIT 1
+    """, (canonical_hash(query),))
+    
+    result = cursor.fetchone()
+    if result is None:
         return None
+    
+    optimization = optimization_from_row(result)
+    literals = query_literals(payload.sqlQuery, payload.databaseEngine)
+    if literals is not None and literals == query_literals(optimization['original_query'], payload.databaseEngine):
+        return {**optimization, 'similarity_score': 1.0, 'similarity_type': "exact_match"}
+    
+    similarity_score = fuzz.ratio(
+        normalize_sql(payload.sqlQuery).lower(), normalize_sql(optimization['original_query']).lower()
+    ) / 100.0
+    return {**optimization, 'similarity_score': similarity_score, 'similarity_type': "canonical_match"}
 
-def find_direct_string_matches(conn, query, similarity_threshold):
-    """Find directly similar queries using string comparison."""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT request_id, original_query FROM QueryRequests")
-    all_queries = cursor.fetchall()
-    
-    matches = []
-    for row in all_queries:
-        similarity = calculate_similarity(query, row['original_query'])
-        if similarity >= similarity_threshold:
-            matches.append({
-                'request_id': row['request_id'],
-                'similarity_score': similarity
-            })
-    
-    # Sort by similarity score descending
-    matches.sort(key=lambda x: x['similarity_score'], reverse=True)
-    return matches
-
-def has_positive_feedback(conn, request_id):
-    """Check if the request has any optimization results with positive feedback."""
+def find_string_match(conn, query, similarity_threshold):
+    """Find the latest optimization of the positively rated request most similar to the query as a string."""
     cursor = conn.cursor()
+    
+    try:
+        # The % operator uses this threshold and can be answered from the GIN index.
+        # pg_trgm lowercases trigrams itself, so no lower() is needed. Only queries with
+        # positive feedback can be answered from history, so the rest are left out here
+        # rather than crowding the rated ones out of the best matches.
+        cursor.execute("SET LOCAL pg_trgm.similarity_threshold = %s", (similarity_threshold,))
+        cursor.execute(f"""
+            SELECT {OPTIMIZATION_COLUMNS}, similarity(qr.canonical_query, %s) AS similarity_score
+            FROM QueryRequests qr
+            JOIN OptimizationResults or2 ON or2.request_id = qr.request_id
+            WHERE qr.canonical_query %% %s AND EXISTS (
+                SELECT 1
+                FROM OptimizationResults r
+                JOIN Feedbacks f ON f.result_id = r.result_id
+                WHERE r.request_id = qr.request_id AND f.is_useful
+            )
+            ORDER BY similarity_score DESC, qr.request_id DESC, or2.created_at DESC
+            LIMIT 1
+        """, (query, query))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        
+        *columns, similarity_score = row
+        return {
+            **optimization_from_row(columns),
+            'similarity_score': float(similarity_score),
+            'similarity_type': "trigram_similarity"
+        }
+    except (psycopg2.errors.UndefinedObject, psycopg2.errors.UndefinedFunction):
+        # pg_trgm is not installed
+        conn.rollback()
+    
+    match = find_lsh_string_match(conn, query, similarity_threshold)
+    if match is None:
+        return None
+    
+    optimization = get_latest_optimization(conn, match['request_id'])
+    if optimization:
+        optimization['similarity_score'] = match['similarity_score']
+        optimization['similarity_type'] = "lsh_similarity"
+    return optimization
+
+def find_lsh_string_match(conn, query, similarity_threshold):
+    """Find the most similar rated query among those sharing a MinHash LSH band, scored with rapidfuzz."""
+    bands = lsh_bands(query)
+    if not bands:
+        return None
+    
+    cursor = conn.cursor()
+    # The GIN index on lsh_bands answers the overlap, so only likely matches are
+    # fetched. Only queries with positive feedback can be answered from history.
     cursor.execute("""
-        SELECT COUNT(*) 
-        FROM OptimizationResults or2
-        JOIN Feedbacks f ON or2.result_id = f.result_id
-        WHERE or2.request_id = %s AND f.is_useful = TRUE
-    """, (request_id,))
+        SELECT qr.request_id, qr.canonical_query
+        FROM QueryRequests qr
+        WHERE qr.lsh_bands && %s::BIGINT[] AND EXISTS (
+            SELECT 1
+            FROM OptimizationResults r
+            JOIN Feedbacks f ON f.result_id = r.result_id
+            WHERE r.request_id = qr.request_id AND f.is_useful
+        )
+        ORDER BY qr.request_id DESC
+        LIMIT %s
+    """, (bands, LSH_CANDIDATES))
+    candidates = cursor.fetchall()
+    if not candidates:
+        return None
+    
+    # Every candidate has positive feedback, so only the best one is needed. extractOne
+    # scores them in native code and raises the cutoff to the best score so far, so weaker
+    # candidates are abandoned early. Canonical queries are already lowercase with
+    # whitespace collapsed, so they are compared without a Python processor; on equal
+    # scores the first, most recent candidate wins.
+    best = process.extractOne(
+        query,
+        [canonical_query or '' for _, canonical_query in candidates],
+        scorer=fuzz.ratio,
+        score_cutoff=similarity_threshold * 100
+    )
+    if best is None:
+        return None
     
-    count = cursor.fetchone()[0]
-    return count > 0
+    _, score, index = best
+    return {'request_id': candidates[index][0], 'similarity_score': float(score) / 100.0}
 
 def get_latest_optimization(conn, request_id):
     """Get the latest optimization result for a request."""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute("""
-        SELECT 
-            or2.result_id,
-            or2.request_id,
-            or2.optimized_query,
-            or2.optimization_explanation,
-            or2.suggested_indexes,
-            or2.suggested_schema_changes,
-            or2.suggested_server_configs,
-            or2.estimated_improvement,
-            qr.original_query
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT {OPTIMIZATION_COLUMNS}
         FROM OptimizationResults or2
         JOIN QueryRequests qr ON or2.request_id = qr.request_id
         WHERE or2.request_id = %s
@@ -621,43 +2098,42 @@ def get_latest_optimization(conn, request_id):
     
     result = cursor.fetchone()
     if result:
-        return dict(result)
+        return optimization_from_row(result)
     return None
 
-def save_similarity_relationship(request_id, similar_request_id, similarity_score, similarity_type):
-    """Save the relationship between similar queries."""
-    try:
-        conn = get_db_connection()
+def get_latest_optimizations(request_ids):
+    """Get the latest optimization result of each of the given requests, keyed by request_id."""
+    with db_conn() as conn:
         cursor = conn.cursor()
-        
-        cursor.execute(
-            """
-            INSERT INTO SimilarQueries 
-            (request_id, similar_request_id, similarity_score, similarity_type) 
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            """,
-            (request_id, similar_request_id, similarity_score, similarity_type)
-        )
-        
-        id = cursor.fetchone()[0]
-        conn.commit()
-        conn.close()
-        return id
-    except Exception as e:
-        print(f"Error saving similarity relationship: {str(e)}")
-        return None
+        cursor.execute(f"""
+            SELECT DISTINCT ON (or2.request_id) {OPTIMIZATION_COLUMNS}
+            FROM OptimizationResults or2
+            JOIN QueryRequests qr ON or2.request_id = qr.request_id
+            WHERE or2.request_id = ANY(%s)
+            ORDER BY or2.request_id, or2.created_at DESC
+        """, (request_ids,))
+        optimizations = {}
+        for row in cursor.fetchall():
+            optimization = optimization_from_row(row)
+            optimizations[optimization['request_id']] = optimization
+        conn.rollback()
+        return optimizations
 
-def calculate_similarity(str1, str2):
-    """Calculate string similarity between two SQL queries."""
-    # Clean and normalize strings
-    str1 = str1.lower().strip()
-    str2 = str2.lower().strip()
-    
-    # Use difflib's SequenceMatcher to calculate similarity
-    similarity = difflib.SequenceMatcher(None, str1, str2).ratio()
-    return similarity
+def save_similarity_relationship(cursor, request_id, similar_request_id, similarity_score, similarity_type):
+    """Insert the relationship between similar queries with the given cursor and return its id."""
+    execute_prepared(
+        cursor,
+        "insert_similar_query",
+        (request_id, similar_request_id, similarity_score, similarity_type)
+    )
+    return cursor.fetchone()[0]
 
 if __name__ == '__main__':
+    # The development server always makes sure the schema exists
+    if os.getenv("RUN_DB_INIT") != "1":
+        init_db_on_startup()
     port = int(os.getenv("PORT", 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # Debug mode and reloading on code changes are opt-in, so running this file never
+    # serves tracebacks or watches files by accident
+    debug = os.getenv("QUART_DEBUG") == "1"
+    app.run(host='0.0.0.0', port=port, debug=debug, use_reloader=debug)
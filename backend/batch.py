@@ -0,0 +1,60 @@
+
+import orjson
+import tempfile
+
+# Endpoint every batched request is sent to
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+async def submit_batch(client, chat_requests):
+    """Upload chat completion requests to the OpenAI Batch API and return the batch id."""
+    # Serialize one request per line, using the list index as the custom_id
+    with tempfile.NamedTemporaryFile(mode="w+b", suffix=".jsonl") as batch_file:
+        for custom_id, body in enumerate(chat_requests):
+            line = {
+                "custom_id": str(custom_id),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": body
+            }
+            batch_file.write(orjson.dumps(line) + b"\n")
+        batch_file.seek(0)
+
+        uploaded_file = await client.files.create(file=batch_file, purpose="batch")
+
+    batch = await client.batches.create(
+        input_file_id=uploaded_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h"
+    )
+    return batch.id
+
+async def retrieve_batch(client, batch_id):
+    """Return the batch and, once it has completed, the raw lines of its output and error files."""
+    batch = await client.batches.retrieve(batch_id)
+
+    if batch.status != "completed":
+        return batch, []
+
+    # Requests that failed are written to the error file instead of the output file
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            content = await client.files.content(file_id)
+            lines.extend(line for line in content.content.splitlines() if line.strip())
+    return batch, lines
+
+def parse_batch_line(line):
+    """Extract custom_id, message content, token usage and finish reason from a batch output line."""
+    entry = orjson.loads(line)
+    response = entry.get("response") or {}
+
+    if entry.get("error") or response.get("status_code") != 200:
+        error = entry.get("error") or response.get("body", {}).get("error")
+        if isinstance(error, dict):
+            error = error.get("message") or error.get("code") or error
+        return entry.get("custom_id"), None, 0, None, error
+
+    body = response["body"]
+    choice = body["choices"][0]
+    tokens_used = body.get("usage", {}).get("total_tokens", 0)
+    return entry.get("custom_id"), choice["message"]["content"], tokens_used, choice.get("finish_reason"), None
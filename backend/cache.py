@@ -0,0 +1,48 @@
+
+import logging
+
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """In-process TTL cache of JSON values, shared between workers through Redis when configured."""
+
+    def __init__(self, maxsize, ttl, redis_url=None, namespace="cache"):
+        # Only touched from the event loop thread, so no lock is needed
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.namespace = namespace
+        self.redis = redis.from_url(redis_url) if redis_url else None
+
+    async def get(self, key):
+        """Return the cached value for key, or None if it isn't cached."""
+        value = self.local.get(key)
+        if value is not None or self.redis is None:
+            return value
+
+        # Fall back to values cached by other workers
+        try:
+            raw = await self.redis.get(f"{self.namespace}:{key}")
+        except redis.RedisError as e:
+            logger.warning("Redis cache read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+
+        value = orjson.loads(raw)
+        self.local[key] = value
+        return value
+
+    async def set(self, key, value):
+        """Cache value under key locally and, if configured, in Redis."""
+        self.local[key] = value
+        if self.redis is None:
+            return
+
+        try:
+            await self.redis.set(f"{self.namespace}:{key}", orjson.dumps(value), ex=self.ttl)
+        except redis.RedisError as e:
+            logger.warning("Redis cache write failed: %s", e)
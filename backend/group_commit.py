@@ -0,0 +1,89 @@
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class GroupCommitter:
+    """Runs database writes from any thread on one connection, committing many together.
+
+    While a group of writes is being executed, newly submitted writes queue up and form
+    the next group, so under load one commit (and WAL flush) covers many requests, while
+    a write submitted to an idle server runs immediately.
+    """
+
+    def __init__(self, connect, max_group_size=64):
+        # connect is a context manager factory yielding a psycopg2 connection
+        self.connect = connect
+        self.max_group_size = max_group_size
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, write, *args):
+        """Queue write(cursor, *args) and return a Future resolved once it has been committed."""
+        future = Future()
+        self.queue.put((write, args, future))
+        self.ensure_started()
+        return future
+
+    def ensure_started(self):
+        # Started on first use, so a process that forks workers never runs it itself
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            group = [self.queue.get()]
+            while len(group) < self.max_group_size:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.write_group(group)
+            except Exception as e:
+                logger.exception("Group commit of %d writes failed", len(group))
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def write_group(self, group):
+        """Execute a group of writes in one transaction and resolve their futures after the commit."""
+        # A savepoint per write keeps one failing write from undoing the others;
+        # a write on its own doesn't need one
+        isolate = len(group) > 1
+        outcomes = []
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            try:
+                for write, args, future in group:
+                    if isolate:
+                        cursor.execute("SAVEPOINT group_write")
+                    try:
+                        outcomes.append((future, write(cursor, *args), None))
+                    except Exception as e:
+                        if not isolate:
+                            raise
+                        cursor.execute("ROLLBACK TO SAVEPOINT group_write")
+                        outcomes.append((future, None, e))
+                    else:
+                        if isolate:
+                            cursor.execute("RELEASE SAVEPOINT group_write")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        # Results are only reported once they are durable
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
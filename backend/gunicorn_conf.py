@@ -0,0 +1,40 @@
+
+# Gunicorn configuration for serving the ASGI app with Uvicorn workers:
+#   gunicorn -c gunicorn_conf.py app:app
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Each Uvicorn worker runs an event loop, so a single process multiplexes many
+# in-flight OpenAI requests; add processes to use more CPU cores
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+# Import the app once in the master so workers share its parsed settings, tokenizer
+# and compiled code through copy-on-write pages instead of each loading them.
+# Database connections and the log thread are recreated in every worker.
+preload_app = True
+
+# OpenAI completions can take longer than Gunicorn's 30 second default
+timeout = 120
+keepalive = 5
+
+# Taken out of the environment before the app is preloaded, so importing it in the
+# master doesn't also initialize the database
+run_db_init = os.environ.pop("RUN_DB_INIT", None) == "1"
+
+def on_starting(server):
+    """With RUN_DB_INIT=1, create the database schema once in the master instead of in every worker."""
+    if not run_db_init:
+        return
+    
+    # Run it in its own interpreter before the workers are forked, so the master doesn't
+    # keep a database connection open that every worker would inherit
+    result = subprocess.run(
+        [sys.executable, "-m", "quart", "--app", "app", "init-db"],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        server.log.error("Database initialization failed, workers will start without it")
@@ -0,0 +1,56 @@
+
+import hashlib
+
+import numpy as np
+
+# 128 MinHash values split into 32 bands of 4. Two queries share a band with high
+# probability once the Jaccard similarity of their shingles is above (1/32)^(1/4) ~ 0.42,
+# which keeps the candidates that score 0.7 or more with fuzz.ratio
+NUM_PERMUTATIONS = 128
+NUM_BANDS = 32
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+
+# Length of the character shingles a query is split into
+SHINGLE_SIZE = 3
+
+# Fixed seed so every process derives the same hash functions and stored bands stay comparable
+_rng = np.random.default_rng(20240615)
+_multipliers = _rng.integers(1, 2**64, size=NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_increments = _rng.integers(0, 2**64, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+def shingle_hashes(text):
+    """Return the 32-bit hashes of the distinct character shingles of a normalized query."""
+    text = " ".join(text.lower().split())
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 0))}
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles],
+        dtype=np.uint64
+    )
+
+def minhash_signature(text):
+    """Return the MinHash signature of a query, or None if it is too short to shingle."""
+    hashes = shingle_hashes(text)
+    if not len(hashes):
+        return None
+
+    # Multiply-shift hashing: one independent hash function per permutation, applied to
+    # every shingle at once; uint64 arithmetic wraps around as intended
+    with np.errstate(over="ignore"):
+        permuted = (hashes[:, None] * _multipliers + _increments) >> np.uint64(32)
+    return permuted.min(axis=0)
+
+def lsh_bands(text):
+    """Return the locality-sensitive band hashes of a query as signed 64-bit integers.
+
+    Queries with similar text share at least one band, so candidates can be found with
+    an indexed array overlap instead of comparing against every stored query.
+    """
+    signature = minhash_signature(text)
+    if signature is None:
+        return []
+
+    bands = []
+    for band, rows in enumerate(signature.reshape(NUM_BANDS, ROWS_PER_BAND)):
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8, person=band.to_bytes(2, "little")).digest()
+        bands.append(int.from_bytes(digest, "little", signed=True))
+    return bands
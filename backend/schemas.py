@@ -0,0 +1,66 @@
+
+from typing import Optional, Union
+
+import orjson
+from pydantic import BaseModel, Field, field_validator
+
+# Per-field size limits, so oversized input is rejected before any OpenAI call
+MAX_QUERY_LENGTH = 50_000
+MAX_CONTEXT_LENGTH = 200_000
+
+# Schema and server context may be sent either as free text or as JSON
+ContextValue = Optional[Union[str, dict, list]]
+
+class RequestValidationError(ValueError):
+    """Raised when a request body is rejected; carries the HTTP status to return."""
+
+    def __init__(self, message, status_code=422, details=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.details = details
+
+    def to_dict(self):
+        body = {"error": self.message}
+        if self.details:
+            body["details"] = self.details
+        return body
+
+def context_size(value):
+    """Return the size in bytes of a context value as it will be sent in the prompt."""
+    if not value:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(orjson.dumps(value))
+
+class OptimizeRequest(BaseModel):
+    """Body of an optimization request."""
+
+    sqlQuery: str = Field(min_length=1, max_length=MAX_QUERY_LENGTH)
+    tableStructure: ContextValue = {}
+    existingIndexes: ContextValue = {}
+    performanceIssue: Optional[str] = Field("", max_length=MAX_CONTEXT_LENGTH)
+    explainResults: ContextValue = {}
+    serverInfo: ContextValue = {}
+    databaseEngine: Optional[str] = Field("MySQL", max_length=50)
+    databaseVersion: Optional[str] = Field("", max_length=50)
+    databaseSize: Optional[int] = Field(0, ge=0)
+
+    @field_validator('tableStructure', 'existingIndexes', 'explainResults', 'serverInfo')
+    @classmethod
+    def check_context_size(cls, value):
+        if context_size(value) > MAX_CONTEXT_LENGTH:
+            raise ValueError(f"must be at most {MAX_CONTEXT_LENGTH} bytes")
+        return value
+
+    def total_size(self):
+        """Return the combined size in bytes of everything copied into the prompt."""
+        return sum(context_size(value) for value in (
+            self.sqlQuery,
+            self.tableStructure,
+            self.existingIndexes,
+            self.performanceIssue,
+            self.explainResults,
+            self.serverInfo
+        ))
@@ -12,7 +12,7 @@ import { Card, CardContent } from "@/components/ui/card";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
 import CodeEditor from "@/components/CodeEditor";
 import OptimizationResult from "@/components/OptimizationResult";
-import { optimizeQuery, OptimizationRequest } from "@/lib/api";
+import { optimizeQueryStream, OptimizationRequest } from "@/lib/api";
 
 const formSchema = z.object({
   sqlQuery: z.string().min(1, "Query is required"),
@@ -28,6 +28,7 @@ type FormValues = z.infer<typeof formSchema>;
 const QueryOptimizer = () => {
   const [isOptimizing, setIsOptimizing] = useState(false);
   const [result, setResult] = useState<any>(null);
+  const [partialResult, setPartialResult] = useState("");
   const { toast } = useToast();
 
   const form = useForm<FormValues>({
@@ -44,6 +45,7 @@ const QueryOptimizer = () => {
 
   const onSubmit = async (data: FormValues) => {
     setIsOptimizing(true);
+    setPartialResult("");
     try {
       // Convert the form data to the API request format
       const requestData: OptimizationRequest = {
@@ -55,7 +57,8 @@ const QueryOptimizer = () => {
         serverInfo: data.serverInfo || undefined,
       };
 
-      const optimizationResult = await optimizeQuery(requestData);
+      // Show the answer as it is generated instead of waiting for all of it
+      const optimizationResult = await optimizeQueryStream(requestData, setPartialResult);
       setResult(optimizationResult);
       
       // Save to history
@@ -254,7 +257,15 @@ const QueryOptimizer = () => {
         </CardContent>
       </Card>
 
-      {result && <OptimizationResult result={result} />}
+      {isOptimizing && partialResult && (
+        <Card>
+          <CardContent className="pt-6">
+            <pre className="whitespace-pre-wrap break-words text-sm text-gray-600">{partialResult}</pre>
+          </CardContent>
+        </Card>
+      )}
+
+      {!isOptimizing && result && <OptimizationResult result={result} />}
     </div>
   );
 };
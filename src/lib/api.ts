@@ -57,6 +57,72 @@ export async function optimizeQuery(data: OptimizationRequest): Promise<Optimiza
   }
 }
 
+/**
+ * Call the streaming endpoint to optimize a query, reporting partial output as it arrives
+ */
+export async function optimizeQueryStream(
+  data: OptimizationRequest,
+  onChunk?: (partial: string) => void
+): Promise<OptimizationResponse> {
+  try {
+    const response = await fetch(`${API_BASE_URL}/api/optimize/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(data),
+    });
+
+    if (!response.ok || !response.body) {
+      const errorText = await response.text();
+      throw new Error(`API error: ${response.status} ${errorText}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let content = "";
+    let result: Partial<OptimizationResponse> = {};
+
+    // Server-sent events are separated by a blank line
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const events = buffer.split("\n\n");
+      buffer = events.pop() ?? "";
+
+      for (const event of events) {
+        const lines = event.split("\n");
+        const payload = lines.find((line) => line.startsWith("data: "))?.slice(6);
+        if (payload === undefined) continue;
+
+        if (lines.includes("event: error")) {
+          throw new Error(`Stream error: ${JSON.parse(payload)}`);
+        }
+
+        // The saved result's id arrives once generation has finished; a cached
+        // answer arrives whole in this event without any content before it
+        if (lines.includes("event: result")) {
+          result = JSON.parse(payload);
+          continue;
+        }
+
+        if (payload === "[DONE]") {
+          return { ...(content ? JSON.parse(content) : {}), originalQuery: data.sqlQuery, ...result };
+        }
+
+        content += JSON.parse(payload);
+        onChunk?.(content);
+      }
+    }
+
+    throw new Error("Stream ended before completion");
+  } catch (error) {
+    console.error("Error optimizing query:", error);
+    throw new Error("Failed to optimize query");
+  }
+}
+
 /**
  * Submit feedback for an optimization result
  */